@@ -1,13 +1,33 @@
+# python imports
+from collections import OrderedDict
+
+# django imports
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Manager
+from django.db.models import Model
+from django.db.models.query import QuerySet
+
 # workflows imports
 import workflows.utils
+from workflows.models import State
+from workflows.models import StateObjectRelation
 
 class WorkflowBase(object):
     """Mixin class to make objects workflow aware.
+
+    The workflow and the state of the object are memoized on the instance
+    after they have been loaded once. The methods of this class which change
+    them update the memoized values; after changing them otherwise (e.g. by
+    setting the workflow of the content type or by another process) call
+    ``refresh_workflow_state``.
     """
     def get_workflow(self):
         """Returns the current workflow of the object.
         """
-        return workflows.utils.get_workflow(self)
+        workflow = workflows.utils.get_workflow(self)
+        setattr(self, workflows.utils._WORKFLOW_ATTR, workflow)
+        return workflow
 
     def remove_workflow(self):
         """Removes the workflow from the object. After this function has been
@@ -38,12 +58,16 @@ class WorkflowBase(object):
     def get_state(self):
         """Returns the current workflow state of the object.
         """
-        return workflows.utils.get_state(self)
+        state = workflows.utils.get_state(self)
+        setattr(self, workflows.utils._STATE_ATTR, state)
+        return state
 
     def set_state(self, state):
         """Sets the workflow state of the object.
         """
-        return workflows.utils.set_state(self, state)
+        result = workflows.utils.set_state(self, state)
+        setattr(self, workflows.utils._STATE_ATTR, state)
+        return result
 
     def set_initial_state(self):
         """Sets the initial state of the current workflow to the object.
@@ -58,4 +82,113 @@ class WorkflowBase(object):
     def do_transition(self, transition, user):
         """Processes the passed transition (if allowed).
         """
-        return workflows.utils.do_transition(self, transition, user)
\ No newline at end of file
+        return workflows.utils.do_transition(self, transition, user)
+
+    def refresh_workflow_state(self):
+        """Discards the memoized workflow and state of the object, so that they
+        are loaded again on the next access.
+        """
+        workflows.utils._clear_prefetched(self)
+
+
+class WorkflowQuerySet(QuerySet):
+    """QuerySet for workflow aware models (see WorkflowBase).
+    """
+    def __init__(self, *args, **kwargs):
+        super(WorkflowQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_workflow_states = False
+
+    def prefetch_workflow_states(self):
+        """Returns a new QuerySet which loads the workflows and workflow
+        states of all its objects at once when it is evaluated. See
+        ``workflows.utils.prefetch_workflow_states``.
+        """
+        clone = self._clone()
+        clone._prefetch_workflow_states = True
+        return clone
+
+    def in_state(self, state):
+        """Returns a new QuerySet which contains only the objects which are in
+        the passed workflow state.
+
+        **Parameters:**
+
+        state
+            The state of the objects. Can be a State instance or a string with
+            the state name.
+        """
+        return self.filter(pk__in=self._get_state_relations(state))
+
+    def exclude_state(self, state):
+        """Returns a new QuerySet which excludes the objects which are in the
+        passed workflow state.
+
+        **Parameters:**
+
+        state
+            The state of the objects. Can be a State instance or a string with
+            the state name.
+        """
+        return self.exclude(pk__in=self._get_state_relations(state))
+
+    def annotate_state(self):
+        """Returns a new QuerySet whose objects have the id and the name of
+        their current workflow state as ``workflow_state_id`` and
+        ``workflow_state_name`` attributes (None if they have no state). Both
+        are calculated within the same query.
+        """
+        qn = connection.ops.quote_name
+        ctype = ContentType.objects.get_for_model(self.model)
+
+        sql = "SELECT %(column)s FROM %(sor)s INNER JOIN %(state)s ON %(sor)s.%(state_id)s = %(state)s.%(id)s " \
+              "WHERE %(sor)s.%(content_type_id)s = %%s AND %(sor)s.%(content_id)s = %(table)s.%(pk)s"
+        params = {
+            "sor": qn(StateObjectRelation._meta.db_table),
+            "state": qn(State._meta.db_table),
+            "state_id": qn(StateObjectRelation._meta.get_field("state").column),
+            "id": qn(State._meta.pk.column),
+            "content_type_id": qn(StateObjectRelation._meta.get_field("content_type").column),
+            "content_id": qn(StateObjectRelation._meta.get_field("content_id").column),
+            "table": qn(self.model._meta.db_table),
+            "pk": qn(self.model._meta.pk.column),
+        }
+
+        select = OrderedDict()
+        select["workflow_state_id"] = sql % dict(params, column="%s.%s" % (params["state"], params["id"]))
+        select["workflow_state_name"] = sql % dict(params, column="%s.%s" % (params["state"], qn(State._meta.get_field("name").column)))
+
+        return self.extra(select=select, select_params=(ctype.id, ctype.id))
+
+    def transitionable(self, transition, user=None):
+        """Returns a new QuerySet which contains only the objects which can
+        take the passed transition (see
+        ``workflows.utils.filter_transitionable``).
+        """
+        return workflows.utils.filter_transitionable(self, transition, user)
+
+    def _get_state_relations(self, state):
+        """Returns the ids of the objects of this QuerySet's model which are
+        in the passed state as subquery.
+        """
+        ctype = ContentType.objects.get_for_model(self.model)
+        sors = StateObjectRelation.objects.filter(content_type=ctype, content_id__isnull=False)
+        if isinstance(state, State):
+            sors = sors.filter(state=state)
+        else:
+            sors = sors.filter(state__name=state)
+        return sors.values("content_id")
+
+    def _clone(self, *args, **kwargs):
+        clone = super(WorkflowQuerySet, self)._clone(*args, **kwargs)
+        clone._prefetch_workflow_states = self._prefetch_workflow_states
+        return clone
+
+    def _fetch_all(self):
+        fetch = self._result_cache is None
+        super(WorkflowQuerySet, self)._fetch_all()
+        if fetch and self._prefetch_workflow_states:
+            objs = [obj for obj in self._result_cache if isinstance(obj, Model)]
+            workflows.utils.prefetch_workflow_states(objs)
+
+
+WorkflowManager = Manager.from_queryset(WorkflowQuerySet)
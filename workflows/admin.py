@@ -1,30 +1,70 @@
 from django.contrib import admin
+from workflows.models import ScheduledTransition
 from workflows.models import State
 from workflows.models import StateInheritanceBlock
+from workflows.models import StateObjectCount
 from workflows.models import StatePermissionRelation
 from workflows.models import StateObjectRelation
+from workflows.models import StateTransitionLog
 from workflows.models import Transition
 from workflows.models import Workflow
 from workflows.models import WorkflowObjectRelation
 from workflows.models import WorkflowModelRelation
 from workflows.models import WorkflowPermissionRelation
+from workflows.models import WorkflowSnapshot
 
 class StateInline(admin.TabularInline):
     model = State
 
+class StateObjectCountInline(admin.TabularInline):
+    """Shows the maintained amounts of objects per state and content type.
+    """
+    model = StateObjectCount
+    fields = ("state", "content_type", "count")
+    readonly_fields = ("state", "content_type", "count")
+    extra = 0
+    max_num = 0
+    can_delete = False
+
+    def get_queryset(self, request):
+        return super(StateObjectCountInline, self).get_queryset(request).select_related("state", "content_type")
+
 class WorkflowAdmin(admin.ModelAdmin):
     inlines = [
         StateInline,
+        StateObjectCountInline,
     ]
 
 admin.site.register(Workflow, WorkflowAdmin)
 
+class StateTransitionLogAdmin(admin.ModelAdmin):
+    """Shows the transition log, which is append-only.
+    """
+    fields = ("content_type", "content_id", "from_state", "to_state", "transition", "user", "timestamp")
+    readonly_fields = fields
+    list_display = ("timestamp", "content_type", "content_id", "from_state", "to_state", "transition", "user")
+    list_select_related = True
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_actions(self, request):
+        actions = super(StateTransitionLogAdmin, self).get_actions(request)
+        actions.pop("delete_selected", None)
+        return actions
+
+admin.site.register(ScheduledTransition)
 admin.site.register(State)
 admin.site.register(StateInheritanceBlock)
 admin.site.register(StateObjectRelation)
 admin.site.register(StatePermissionRelation)
+admin.site.register(StateTransitionLog, StateTransitionLogAdmin)
 admin.site.register(Transition)
 admin.site.register(WorkflowObjectRelation)
 admin.site.register(WorkflowModelRelation)
 admin.site.register(WorkflowPermissionRelation)
+admin.site.register(WorkflowSnapshot)
 
@@ -0,0 +1,224 @@
+"""Shared cache for the workflows and states of objects and content types.
+
+If the ``WORKFLOWS_CACHE`` setting is the alias of a cache (see Django's
+``CACHES`` setting), ``get_workflow_for_object``, ``get_workflow_for_model``
+and ``get_state`` look up the cache before they query the database and fill
+it with the values they have read, unless they run within a transaction (the
+values might not have been committed yet). The functions which change
+workflows or states drop the cached values at once and cache the new ones
+after the transaction has been committed: with ``transaction.on_commit`` if
+Django provides it, at the end of the outermost ``workflows.utils.batch``,
+or immediately if no transaction is open. Otherwise (Django < 1.9) the new
+values are left to the next read.
+
+All keys are versioned with a generation which is stored within the cache
+itself. ``invalidate`` increases it, which drops all cached values at once;
+this is done by bulk operations (e.g. ``remove_workflow_from_model``) and
+when a workflow or state is changed. The ``WORKFLOWS_CACHE_TIMEOUT`` setting
+(default: 300 seconds) limits how long a value is kept.
+"""
+# python imports
+import time
+
+# django imports
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+# workflows imports
+from workflows.models import State
+from workflows.models import Workflow
+
+# Returned by the getters if the value is not cached (None is a valid value)
+MISSING = object()
+
+_GENERATION_KEY = "workflows:generation"
+
+
+def is_enabled():
+    """Returns True if the cache is used.
+    """
+    return bool(getattr(settings, "WORKFLOWS_CACHE", None))
+
+
+def get_object_workflow(ctype, content_id):
+    """Returns the cached own workflow of the object with passed content type
+    and id (None if it has none) or MISSING.
+    """
+    return _get(_get_key("object", ctype, content_id))
+
+
+def set_object_workflow(ctype, content_id, workflow):
+    """Caches the changed own workflow (or None) of the object with passed
+    content type and id after commit.
+    """
+    _write({_get_key("object", ctype, content_id): workflow})
+
+
+def fill_object_workflow(ctype, content_id, workflow):
+    """Caches the own workflow (or None) of the object with passed content
+    type and id which has been read from the database.
+    """
+    _fill({_get_key("object", ctype, content_id): workflow})
+
+
+def get_model_workflow(ctype):
+    """Returns the cached workflow of the passed content type (None if it has
+    none) or MISSING.
+    """
+    return _get(_get_key("model", ctype))
+
+
+def set_model_workflow(ctype, workflow):
+    """Caches the changed workflow (or None) of the passed content type after
+    commit.
+    """
+    _write({_get_key("model", ctype): workflow})
+
+
+def fill_model_workflow(ctype, workflow):
+    """Caches the workflow (or None) of the passed content type which has
+    been read from the database.
+    """
+    _fill({_get_key("model", ctype): workflow})
+
+
+def get_state(ctype, content_id):
+    """Returns the cached state of the object with passed content type and id
+    (None if it has none) or MISSING.
+    """
+    return _get(_get_key("state", ctype, content_id))
+
+
+def set_state(ctype, content_ids, state):
+    """Caches the changed state (or None) of the objects with passed content
+    type and ids after commit.
+    """
+    _write(dict((_get_key("state", ctype, content_id), state) for content_id in content_ids))
+
+
+def fill_state(ctype, content_id, state):
+    """Caches the state (or None) of the object with passed content type and
+    id which has been read from the database.
+    """
+    _fill({_get_key("state", ctype, content_id): state})
+
+
+def delete_state(ctype, content_ids):
+    """Removes the cached states of the objects with passed content type and
+    ids.
+    """
+    _delete_many([_get_key("state", ctype, content_id) for content_id in content_ids])
+
+
+def invalidate():
+    """Drops all cached values by increasing the generation. Within a
+    transaction this is repeated after commit, as values of the former state
+    might be cached meanwhile by other processes.
+    """
+    if not is_enabled():
+        return
+
+    _increase_generation()
+    if connection.in_atomic_block:
+        import workflows.utils
+        workflows.utils._after_commit(_increase_generation)
+
+
+# Private ####################################################################
+
+def _increase_generation():
+    cache = _get_cache()
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError:
+        cache.set(_GENERATION_KEY, _new_generation(), None)
+
+
+def _get_cache():
+    return caches[settings.WORKFLOWS_CACHE]
+
+
+def _get_timeout():
+    return getattr(settings, "WORKFLOWS_CACHE_TIMEOUT", 300)
+
+
+def _new_generation():
+    """Returns a generation for a missing (e.g. evicted) generation key which
+    differs from the former ones.
+    """
+    return int(time.time() * 1000)
+
+
+def _get_generation(cache):
+    generation = cache.get(_GENERATION_KEY)
+    if generation is None:
+        cache.add(_GENERATION_KEY, _new_generation(), None)
+        generation = cache.get(_GENERATION_KEY)
+    return generation
+
+
+def _get_key(kind, ctype, content_id=None):
+    ctype_id = getattr(ctype, "id", ctype)
+    if content_id is None:
+        return "workflows:%s:%s" % (kind, ctype_id)
+    return "workflows:%s:%s:%s" % (kind, ctype_id, content_id)
+
+
+def _get(key):
+    if not is_enabled():
+        return MISSING
+
+    cache = _get_cache()
+    # Values are wrapped, so that a cached None can be told from a miss.
+    value = cache.get(key, version=_get_generation(cache))
+    if value is None:
+        return MISSING
+    return value[0]
+
+
+def _write(values):
+    """Drops the passed changed values at once and caches them after commit.
+    """
+    if not is_enabled() or not values:
+        return
+
+    _delete_many(list(values.keys()))
+    import workflows.utils
+    workflows.utils._after_commit(lambda: _set_many(values))
+
+
+def _fill(values):
+    """Caches the passed values which have been read from the database
+    unless a transaction is open.
+    """
+    if not connection.in_atomic_block:
+        _set_many(values)
+
+
+def _delete_many(keys):
+    if is_enabled():
+        cache = _get_cache()
+        cache.delete_many(keys, version=_get_generation(cache))
+
+
+def _set_many(values):
+    if not is_enabled() or not values:
+        return
+
+    cache = _get_cache()
+    cache.set_many(dict((key, (value, )) for key, value in values.items()),
+                   _get_timeout(), version=_get_generation(cache))
+
+
+def _invalidate_definition(sender, **kwargs):
+    """Drops the cached workflows and states if one of them has been changed.
+    """
+    invalidate()
+
+
+for model in (Workflow, State):
+    post_save.connect(_invalidate_definition, sender=model, dispatch_uid="workflows.cache.%s.save" % model.__name__)
+    post_delete.connect(_invalidate_definition, sender=model, dispatch_uid="workflows.cache.%s.delete" % model.__name__)
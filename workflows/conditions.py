@@ -0,0 +1,314 @@
+"""Evaluation of transition conditions.
+
+A condition is a restricted python expression, e.g.::
+
+    obj.title != "" and user.is_staff
+
+Within the expression the names ``obj`` (the object), ``user`` (the user) and
+``state`` (the current state of the object) are available. Only literals,
+boolean operations, comparisons, arithmetic and attribute access (without
+leading underscores) are allowed; function calls, subscripts, lambdas, etc.
+are rejected. Each condition is parsed and validated once and cached as code
+object per transition until the transition is changed.
+
+Conditions which only compare fields of ``obj`` (e.g. ``obj.status == "ok"``
+or ``obj.created < obj.modified``) with literals or attributes of ``user``
+can also be translated into a ``Q`` object on the content model (see
+``compile_q``), so that they can be checked within the database.
+"""
+# python imports
+import ast
+import logging
+
+# django imports
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models import F
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+# workflows imports
+from workflows.models import Transition
+
+# The names which are available within conditions
+NAMES = ("obj", "user", "state")
+
+logger = logging.getLogger(__name__)
+
+# Compiled conditions per transition id: (source, code)
+_compiled = {}
+
+_ALLOWED_NODES = tuple(getattr(ast, name) for name in (
+    "Expression", "BoolOp", "And", "Or", "UnaryOp", "Not", "USub", "UAdd",
+    "Compare", "Eq", "NotEq", "Lt", "LtE", "Gt", "GtE", "In", "NotIn", "Is", "IsNot",
+    "BinOp", "Add", "Sub", "Mult", "Div", "Mod", "IfExp",
+    "Name", "Load", "Attribute", "List", "Tuple",
+    "Num", "Str", "Bytes", "NameConstant", "Constant",
+) if hasattr(ast, name))
+
+_CONSTANT_NAMES = ("True", "False", "None")
+
+# The fields which can be checked on their own by compile_q
+_BOOLEAN_FIELDS = tuple(getattr(models, name) for name in (
+    "BooleanField", "NullBooleanField",
+) if hasattr(models, name))
+
+
+class ConditionError(ValueError):
+    """Raised if a condition is not a valid restricted expression.
+    """
+
+
+def compile_condition(condition):
+    """Parses and validates the passed condition and returns its code object.
+    Raises ConditionError if the condition is invalid.
+
+    **Parameters:**
+
+    condition
+        The condition as string.
+    """
+    try:
+        tree = ast.parse(condition.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ConditionError("Invalid syntax: %s" % e)
+
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ConditionError("%s is not allowed within conditions." % node.__class__.__name__)
+        if isinstance(node, ast.Name) and node.id not in NAMES + _CONSTANT_NAMES:
+            raise ConditionError("Unknown name '%s', available are: %s." % (node.id, ", ".join(NAMES)))
+        if isinstance(node, ast.Attribute) and node.attr.startswith("_"):
+            raise ConditionError("Private attribute '%s' is not allowed within conditions." % node.attr)
+
+    return compile(tree, "<condition>", "eval")
+
+
+def get_code(transition):
+    """Returns the cached code object of the passed transition's condition or
+    None if the transition has no condition.
+    """
+    condition = transition.condition.strip()
+    if not condition:
+        return None
+
+    try:
+        source, code = _compiled[transition.id]
+    except KeyError:
+        pass
+    else:
+        if source == condition:
+            return code
+
+    code = compile_condition(condition)
+    if transition.id is not None:
+        _compiled[transition.id] = (condition, code)
+    return code
+
+
+def evaluate(transition, obj, user, state=None):
+    """Returns True if the condition of the passed transition is fulfilled for
+    passed object, user and state (or if the transition has no condition).
+
+    Invalid conditions and conditions which raise an exception are regarded
+    as not fulfilled. Both are logged; use ``check_conditions`` to find the
+    invalid ones.
+    """
+    try:
+        code = get_code(transition)
+    except ConditionError as e:
+        logger.warning("Invalid condition of transition %s (%s): %s", transition.id, transition.name, e)
+        return False
+    if code is None:
+        return True
+
+    try:
+        return bool(eval(code, {"__builtins__": {}}, {"obj": obj, "user": user, "state": state}))
+    except Exception:
+        logger.warning("The condition of transition %s (%s) failed for %r.", transition.id, transition.name, obj,
+                       exc_info=True)
+        return False
+
+
+def check_conditions(transitions=None):
+    """Returns the transitions with invalid conditions together with the
+    errors as list of tuples.
+
+    **Parameters:**
+
+    transitions
+        The transitions which are checked. Defaults to all transitions.
+    """
+    if transitions is None:
+        transitions = Transition.objects.exclude(condition="").order_by("workflow", "name")
+
+    result = []
+    for transition in transitions:
+        if transition.condition.strip():
+            try:
+                compile_condition(transition.condition)
+            except ConditionError as e:
+                result.append((transition, e))
+    return result
+
+
+def compile_q(condition, user=None, model=None):
+    """Translates the passed condition into a Q object on the content model.
+    Raises ConditionError if the condition is invalid or can't be translated.
+
+    Comparisons (``==``, ``!=``, ``<``, ``<=``, ``>``, ``>=``, ``in``,
+    ``not in``, ``is None``, ``is not None``) of fields of ``obj`` with values
+    or other fields of ``obj``, combined with ``and``, ``or`` and ``not``, can
+    be translated. Related fields are followed, e.g. ``obj.author.username``.
+    A boolean field on its own (e.g. ``obj.is_active``) is compared with
+    True; other fields on their own (e.g. ``obj.title``, whose truth depends
+    on its value) can't be translated. Values might reference attributes of
+    the passed user; ``state`` is not available.
+
+    **Parameters:**
+
+    condition
+        The condition as string.
+
+    user
+        The user for whom the condition is checked.
+
+    model
+        The content model. It is needed to check fields on their own.
+    """
+    compile_condition(condition)
+    tree = ast.parse(condition.strip(), mode="eval")
+    return _QCompiler(user, model).compile(tree.body)
+
+
+class _QCompiler(object):
+    """Translates the nodes of a validated condition into Q objects.
+    """
+    # Lookups per comparison operator and the operators for swapped operands
+    LOOKUPS = {ast.Eq: "exact", ast.Lt: "lt", ast.LtE: "lte", ast.Gt: "gt", ast.GtE: "gte", ast.In: "in"}
+    SWAPPED = {ast.Eq: ast.Eq, ast.NotEq: ast.NotEq, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+
+    def __init__(self, user, model=None):
+        self.user = user
+        self.model = model
+
+    def compile(self, node):
+        # Parts without fields are evaluated at once.
+        if not any(isinstance(child, ast.Name) and child.id == "obj" for child in ast.walk(node)):
+            return self.constant(self.get_value(node))
+
+        if isinstance(node, ast.BoolOp):
+            qs = [self.compile(value) for value in node.values]
+            result = qs[0]
+            for q in qs[1:]:
+                result = result & q if isinstance(node.op, ast.And) else result | q
+            return result
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ~self.compile(node.operand)
+
+        if isinstance(node, ast.Compare):
+            result = Q()
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                result &= self.compare(left, op, right)
+                left = right
+            return result
+
+        path = self.get_path(node)
+        if path is None:
+            raise ConditionError("%s of fields can't be checked within the database." % node.__class__.__name__)
+        if not isinstance(self.get_field(path), _BOOLEAN_FIELDS):
+            raise ConditionError("Only boolean fields can be checked on their own, '%s' must be compared." % path)
+        return Q(**{path: True})
+
+    def compare(self, left, op, right):
+        left_path, right_path = self.get_path(left), self.get_path(right)
+
+        if left_path is None and right_path is None:
+            # Raises ConditionError if one side is an expression of fields
+            return self.constant(self.get_value(ast.Compare(left=left, ops=[op], comparators=[right])))
+
+        if left_path is None:
+            if op.__class__ not in self.SWAPPED:
+                raise ConditionError("The field of obj must be on the left side of '%s'." % op.__class__.__name__)
+            left, right, left_path, right_path = right, left, right_path, left_path
+            op = self.SWAPPED[op.__class__]()
+
+        if right_path is not None:
+            if op.__class__ not in self.SWAPPED:
+                raise ConditionError("Fields of obj can't be compared by '%s'." % op.__class__.__name__)
+            value = F(right_path)
+        else:
+            value = self.get_value(right)
+
+        if isinstance(op, (ast.Is, ast.IsNot)):
+            if value is not None:
+                raise ConditionError("Fields of obj can only be compared with None by identity.")
+            return Q(**{left_path + "__isnull": isinstance(op, ast.Is)})
+
+        if value is None and isinstance(op, (ast.Eq, ast.NotEq)):
+            return Q(**{left_path + "__isnull": isinstance(op, ast.Eq)})
+
+        if isinstance(op, ast.NotEq):
+            return ~Q(**{left_path: value})
+        if isinstance(op, ast.NotIn):
+            return ~Q(**{left_path + "__in": value})
+        return Q(**{"%s__%s" % (left_path, self.LOOKUPS[op.__class__]): value})
+
+    def constant(self, value):
+        """Returns a Q object which matches all objects if the passed value is
+        true and none otherwise. (An empty Q object would be dropped when it
+        is combined with others.)
+        """
+        return ~Q(pk__in=[]) if value else Q(pk__in=[])
+
+    def get_path(self, node):
+        """Returns the field path (e.g. "author__username") if the passed node
+        is an attribute of obj, otherwise None.
+        """
+        attrs = []
+        while isinstance(node, ast.Attribute):
+            attrs.insert(0, node.attr)
+            node = node.value
+        if isinstance(node, ast.Name) and node.id == "obj" and attrs:
+            return "__".join(attrs)
+        return None
+
+    def get_field(self, path):
+        """Returns the field of the model for the passed field path or None if
+        the model is unknown.
+        """
+        model, field = self.model, None
+        for name in path.split("__"):
+            if model is None:
+                return None
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                raise ConditionError("Unknown field '%s'." % path)
+            model = getattr(field, "related_model", None)
+        return field
+
+    def get_value(self, node):
+        """Evaluates the passed node, which must not reference obj or state.
+        """
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and child.id in ("obj", "state"):
+                raise ConditionError("'%s' can't be checked within the database here." % child.id)
+        expression = ast.fix_missing_locations(ast.Expression(body=node))
+        try:
+            return eval(compile(expression, "<condition>", "eval"), {"__builtins__": {}}, {"user": self.user})
+        except Exception as e:
+            raise ConditionError("The condition can't be evaluated: %s" % e)
+
+
+def _invalidate(sender, instance, **kwargs):
+    """Removes the compiled condition of the changed transition.
+    """
+    _compiled.pop(instance.id, None)
+
+
+post_save.connect(_invalidate, sender=Transition, dispatch_uid="workflows.conditions.save")
+post_delete.connect(_invalidate, sender=Transition, dispatch_uid="workflows.conditions.delete")
@@ -0,0 +1,484 @@
+# python imports
+import collections
+import json
+import os
+import time
+
+# django imports
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+# permissions imports
+from permissions.models import Permission
+from permissions.models import Role
+
+# workflows imports
+from workflows.models import State
+from workflows.models import StateInheritanceBlock
+from workflows.models import StatePermissionRelation
+from workflows.models import Transition
+from workflows.models import Workflow
+from workflows.models import WorkflowPermissionRelation
+from workflows.models import WorkflowSnapshot
+
+# Compiled graphs per workflow id
+_graphs = {}
+
+
+class WorkflowGraph(object):
+    """A compiled, read-only representation of a workflow definition. It is
+    built with a fixed number of queries (or from a snapshot of the
+    definition, see ``get_definition``) and kept in memory until one of the
+    underlying definitions changes (see ``get_graph``).
+
+    The contained model instances are shared and must not be modified.
+
+    **Attributes:**
+
+    workflow
+        The workflow the graph belongs to.
+
+    initial_state
+        The initial state of the workflow (see ``Workflow.get_initial_state``).
+
+    states
+        The states of the workflow by id.
+
+    permissions
+        The permissions the workflow is responsible for.
+    """
+    def __init__(self, workflow, definition=None):
+        if definition is None:
+            definition = get_definition(workflow)
+
+        self.workflow = Workflow(**definition["workflow"])
+
+        permissions = dict((p["id"], Permission(**p)) for p in definition["permissions"])
+        roles = dict((r["id"], Role(**r)) for r in definition["roles"])
+
+        self.states = {}
+        states = {}
+        for data in definition["states"] + definition["other_states"]:
+            state = states[data["id"]] = State(**data)
+            if state.workflow_id == self.workflow.id:
+                state.workflow = self.workflow
+                self.states[state.id] = state
+
+        transitions = {}
+        for data in definition["transitions"]:
+            transition = transitions[data["id"]] = Transition(**data)
+            transition.destination = states.get(transition.destination_id)
+            transition.permission = permissions.get(transition.permission_id)
+
+        self._transitions = dict((state_id, []) for state_id in self.states)
+        for state_id, transition_id in definition["state_transitions"]:
+            self._transitions[state_id].append(transitions[transition_id])
+        self._transitions = dict((state_id, tuple(ts)) for state_id, ts in self._transitions.items())
+
+        self._transitions_by_name = {}
+        for transition in sorted(transitions.values(), key=lambda t: t.id):
+            if transition.workflow_id == self.workflow.id:
+                self._transitions_by_name.setdefault(transition.name, transition)
+
+        self._grants = dict((state_id, set()) for state_id in self.states)
+        for state_id, role_id, permission_id in definition["grants"]:
+            self._grants[state_id].add((roles[role_id], permissions[permission_id]))
+        self._grants = dict((state_id, frozenset(grants)) for state_id, grants in self._grants.items())
+
+        self._blocks = dict((state_id, set()) for state_id in self.states)
+        for state_id, permission_id in definition["blocks"]:
+            self._blocks[state_id].add(permissions[permission_id])
+        self._blocks = dict((state_id, frozenset(blocks)) for state_id, blocks in self._blocks.items())
+
+        self.permissions = frozenset(permissions[permission_id] for permission_id in definition["managed"])
+
+        if self.workflow.initial_state_id in self.states:
+            self.initial_state = self.states[self.workflow.initial_state_id]
+        elif self.states:
+            self.initial_state = sorted(self.states.values(), key=lambda s: (s.name, s.id))[0]
+        else:
+            self.initial_state = None
+
+    def get_transitions(self, state):
+        """Returns the outgoing transitions of the passed state.
+        """
+        return self._transitions.get(state.id, ())
+
+    def get_transition(self, name):
+        """Returns the transition of the workflow with the passed name or None.
+        """
+        return self._transitions_by_name.get(name)
+
+    def get_grants(self, state):
+        """Returns the granted permissions of the passed state as set of
+        (role, permission) tuples.
+        """
+        return self._grants.get(state.id, frozenset())
+
+    def get_blocks(self, state):
+        """Returns the permissions for which the passed state blocks the
+        inheritance.
+        """
+        return self._blocks.get(state.id, frozenset())
+
+    def get_reachable_states(self, state=None):
+        """Returns the states of the workflow which can be reached from the
+        passed state (including the state itself).
+
+        **Parameters:**
+
+        state
+            The state to start from. Defaults to the initial state.
+        """
+        state = state or self.initial_state
+        if state is None:
+            return frozenset()
+        return frozenset(self.states[state_id] for state_id in self._search(state))
+
+    def get_unreachable_states(self):
+        """Returns the states of the workflow which can't be reached from the
+        initial state.
+        """
+        return frozenset(self.states.values()) - self.get_reachable_states()
+
+    def get_sink_states(self):
+        """Returns the states of the workflow which can't be left, i.e. which
+        have no transition to another state.
+        """
+        return frozenset(state for state in self.states.values() if not any(
+            transition.destination_id != state.id for transition in self.get_transitions(state)))
+
+    def get_path(self, source, target, is_allowed=None):
+        """Returns the shortest list of transitions which lead from the source
+        state to the target state, or None if there is none. Of several
+        shortest paths the one with the first transitions (in the order of
+        ``get_transitions``) is returned.
+
+        **Parameters:**
+
+        source
+            The state to start from.
+
+        target
+            The state to reach.
+
+        is_allowed
+            If given, only transitions for which ``is_allowed(state,
+            transition)`` returns True are taken.
+        """
+        found = self._search(source, is_allowed, target)
+        if target.id not in found:
+            return None
+
+        path = []
+        state_id = target.id
+        while state_id != source.id:
+            state_id, transition = found[state_id]
+            path.insert(0, transition)
+        return path
+
+    def _search(self, source, is_allowed=None, target=None):
+        """Searches the states which can be reached from the source state
+        breadth-first and returns a dictionary which maps their ids to the id
+        of the previous state and the transition which leads to them. Stops
+        as soon as the target state (if given) has been reached.
+        """
+        found = {source.id: None}
+        queue = collections.deque([source.id])
+        while queue:
+            state_id = queue.popleft()
+            if target is not None and state_id == target.id:
+                break
+            state = self.states.get(state_id)
+            if state is None:
+                continue
+            for transition in self._transitions.get(state_id, ()):
+                destination_id = transition.destination_id
+                # States of other workflows are not followed.
+                if destination_id in found or destination_id not in self.states:
+                    continue
+                if is_allowed is not None and not is_allowed(state, transition):
+                    continue
+                found[destination_id] = (state_id, transition)
+                queue.append(destination_id)
+        return found
+
+
+def get_definition(workflow):
+    """Returns the definition of the passed workflow (states, transitions,
+    permissions and inheritance blocks) as JSON serializable dictionary.
+
+    **Parameters:**
+
+    workflow
+        The workflow for which the definition is returned. Can be a Workflow
+        instance or the id of a workflow.
+    """
+    if not isinstance(workflow, Workflow):
+        workflow = Workflow.objects.get(pk=workflow)
+
+    def state_data(state):
+        return {"id": state.id, "name": state.name, "workflow_id": state.workflow_id}
+
+    def permission_data(permission):
+        return {"id": permission.id, "name": permission.name, "codename": permission.codename}
+
+    states = list(State.objects.filter(workflow=workflow).order_by("id"))
+    state_ids = set(state.id for state in states)
+
+    permissions = {}
+    transitions = []
+    other_states = {}
+    for transition in Transition.objects.filter(
+            Q(workflow=workflow) | Q(states__workflow=workflow)).distinct().select_related(
+            "destination", "permission").order_by("id"):
+        transitions.append({
+            "id": transition.id, "name": transition.name, "workflow_id": transition.workflow_id,
+            "destination_id": transition.destination_id, "condition": transition.condition,
+            "permission_id": transition.permission_id,
+        })
+        if transition.destination_id is not None and transition.destination_id not in state_ids:
+            other_states[transition.destination_id] = state_data(transition.destination)
+        if transition.permission is not None:
+            permissions[transition.permission_id] = permission_data(transition.permission)
+
+    state_transitions = [list(row) for row in State.transitions.through.objects.filter(
+        state__workflow=workflow).order_by("transition", "state").values_list("state", "transition")]
+
+    roles = {}
+    grants = []
+    for spr in StatePermissionRelation.objects.filter(
+            state__workflow=workflow).select_related("role", "permission").order_by("id"):
+        grants.append([spr.state_id, spr.role_id, spr.permission_id])
+        roles[spr.role_id] = {"id": spr.role.id, "name": spr.role.name}
+        permissions[spr.permission_id] = permission_data(spr.permission)
+
+    blocks = []
+    for sib in StateInheritanceBlock.objects.filter(
+            state__workflow=workflow).select_related("permission").order_by("id"):
+        blocks.append([sib.state_id, sib.permission_id])
+        permissions[sib.permission_id] = permission_data(sib.permission)
+
+    managed = []
+    for wpr in WorkflowPermissionRelation.objects.filter(workflow=workflow).select_related("permission").order_by("id"):
+        managed.append(wpr.permission_id)
+        permissions[wpr.permission_id] = permission_data(wpr.permission)
+
+    return {
+        "workflow": {"id": workflow.id, "name": workflow.name, "initial_state_id": workflow.initial_state_id},
+        "states": [state_data(state) for state in states],
+        "other_states": sorted(other_states.values(), key=lambda s: s["id"]),
+        "transitions": transitions,
+        "state_transitions": state_transitions,
+        "permissions": sorted(permissions.values(), key=lambda p: p["id"]),
+        "roles": sorted(roles.values(), key=lambda r: r["id"]),
+        "grants": grants,
+        "blocks": blocks,
+        "managed": managed,
+    }
+
+
+def get_graph(workflow):
+    """Returns the compiled graph of the passed workflow. The graph is built
+    on the first call and cached in memory until the workflow definition
+    changes.
+
+    Every change of a definition increases the generation of the workflow
+    (stored within its ``WorkflowSnapshot``). The generations of the cached
+    graphs are checked every ``WORKFLOWS_GRAPH_CHECK_INTERVAL`` seconds
+    (default: 5) with a single query, so that definitions which have been
+    changed by other processes are reloaded.
+
+    If the ``WORKFLOWS_SNAPSHOTS`` setting is True, the graph is loaded from
+    the workflow's snapshot with a single query (or from the file given by
+    the ``WORKFLOWS_SNAPSHOT_FILE`` setting, see ``dump_snapshots``).
+
+    **Parameters:**
+
+    workflow
+        The workflow for which the graph is returned. Can be a Workflow
+        instance or the id of a workflow.
+    """
+    workflow_id = getattr(workflow, "id", workflow)
+    _check_generations()
+
+    try:
+        return _graphs[workflow_id]
+    except KeyError:
+        pass
+
+    if _use_snapshots():
+        generation, definition = _get_snapshot(workflow)
+        graph = _graphs[workflow_id] = WorkflowGraph(workflow, definition)
+        _generations[workflow_id] = generation
+        return graph
+
+    # The generation is read first, so that a change while the graph is
+    # built is detected by the next check.
+    generation = _get_generation(workflow_id)
+    if not isinstance(workflow, Workflow):
+        workflow = Workflow.objects.get(pk=workflow_id)
+
+    graph = _graphs[workflow_id] = WorkflowGraph(workflow)
+    _generations[workflow_id] = generation
+    return graph
+
+
+def invalidate(workflow_id=None):
+    """Removes the compiled graph of the workflow with passed id from the
+    cache. If no id is given all graphs are removed (and the next generation
+    check is due after the check interval).
+    """
+    if workflow_id is None:
+        _graphs.clear()
+        _generations.clear()
+        if _check_state["checked_at"] is not None:
+            _check_state["checked_at"] = time.time()
+    else:
+        _graphs.pop(workflow_id, None)
+        _generations.pop(workflow_id, None)
+
+
+def dump_snapshots(path):
+    """Writes the snapshots of all workflows to the file with passed path.
+    Processes which have the file set as ``WORKFLOWS_SNAPSHOT_FILE`` load all
+    graphs from it without any query.
+    """
+    snapshots = []
+    for workflow in Workflow.objects.order_by("id"):
+        generation, definition = _get_snapshot(workflow)
+        snapshots.append({"workflow": workflow.id, "generation": generation, "definition": definition})
+
+    with open(path, "w") as f:
+        json.dump({"snapshots": snapshots}, f)
+
+
+# Private ####################################################################
+
+# The generations of the cached graphs and the state of the snapshot file /
+# generation checks.
+_generations = {}
+_check_state = {"file_loaded": False, "checked_at": None}
+
+
+def _use_snapshots():
+    return getattr(settings, "WORKFLOWS_SNAPSHOTS", False)
+
+
+def _get_generation(workflow_id):
+    """Returns the current generation of the workflow with passed id. A
+    workflow without snapshot has the generation 0.
+    """
+    generation = WorkflowSnapshot.objects.filter(workflow=workflow_id).values_list("generation", flat=True).first()
+    return generation or 0
+
+
+def _get_snapshot(workflow):
+    """Returns the generation and the definition of the passed workflow (or
+    workflow id) from its snapshot. If the snapshot doesn't exist or is
+    outdated it is rebuilt.
+    """
+    workflow_id = getattr(workflow, "id", workflow)
+    row = WorkflowSnapshot.objects.filter(workflow=workflow_id).values_list("generation", "data").first()
+    if row is not None and row[1]:
+        return row[0], json.loads(row[1])
+
+    definition = get_definition(workflow)
+    data = json.dumps(definition)
+    if row is None:
+        try:
+            with transaction.atomic():
+                WorkflowSnapshot.objects.create(workflow_id=workflow_id, data=data)
+        except IntegrityError:
+            # Created concurrently, the generation is checked later on.
+            return None, definition
+        return 0, definition
+
+    # Only store the data if the definition hasn't been changed meanwhile
+    WorkflowSnapshot.objects.filter(workflow=workflow_id, generation=row[0]).update(data=data)
+    return row[0], definition
+
+
+def _check_generations():
+    """Loads the snapshot file (if snapshots are used) on the first call and
+    removes the graphs whose generations have changed since they have been
+    loaded, at most once per check interval.
+    """
+    now = time.time()
+    if not _check_state["file_loaded"]:
+        _check_state["file_loaded"] = True
+        _check_state["checked_at"] = now
+
+        path = getattr(settings, "WORKFLOWS_SNAPSHOT_FILE", None)
+        if path and _use_snapshots() and os.path.exists(path):
+            with open(path) as f:
+                for snapshot in json.load(f)["snapshots"]:
+                    _graphs[snapshot["workflow"]] = WorkflowGraph(None, snapshot["definition"])
+                    _generations[snapshot["workflow"]] = snapshot["generation"]
+        return
+
+    if now - _check_state["checked_at"] < getattr(settings, "WORKFLOWS_GRAPH_CHECK_INTERVAL", 5):
+        return
+    _check_state["checked_at"] = now
+    if not _generations:
+        return
+
+    current = dict(WorkflowSnapshot.objects.values_list("workflow", "generation"))
+    for workflow_id, generation in list(_generations.items()):
+        if current.get(workflow_id, 0) != generation:
+            invalidate(workflow_id)
+
+
+def _get_changed_workflows(instance):
+    """Returns a filter for the snapshots of the workflows whose definitions
+    are affected by the passed changed instance, or None if it might be any.
+    """
+    if isinstance(instance, Workflow):
+        return Q(workflow=instance.id)
+    if isinstance(instance, WorkflowPermissionRelation):
+        return Q(workflow=instance.workflow_id)
+    if isinstance(instance, (StatePermissionRelation, StateInheritanceBlock)):
+        return Q(workflow__in=State.objects.filter(pk=instance.state_id).values("workflow"))
+    # States and transitions might be part of other workflows' definitions
+    # (as destinations / source states), permissions and roles of any.
+    return None
+
+
+def _invalidate_definition(sender, **kwargs):
+    """Invalidates all graphs if a part of a workflow definition has been
+    changed. As definitions change rarely, all graphs are invalidated instead
+    of determining the affected ones (which might need further queries).
+
+    The generations of the affected workflows are increased (and their
+    snapshots dropped), so that other processes reload them. The snapshot
+    which holds the generation is created when a workflow is saved.
+    """
+    if not kwargs.get("action", "post_").startswith("post_"):
+        return
+
+    invalidate()
+
+    instance = kwargs["instance"]
+    if isinstance(instance, Workflow) and "created" in kwargs:
+        WorkflowSnapshot.objects.get_or_create(workflow=instance)
+
+    changed = _get_changed_workflows(instance)
+    snapshots = WorkflowSnapshot.objects.all()
+    if changed is not None:
+        snapshots = snapshots.filter(changed)
+    snapshots.update(generation=F("generation") + 1, data="")
+
+
+for model in (Workflow, State, Transition, StatePermissionRelation, StateInheritanceBlock,
+              WorkflowPermissionRelation, Permission, Role):
+    post_save.connect(_invalidate_definition, sender=model, dispatch_uid="workflows.graph.%s.save" % model.__name__)
+    post_delete.connect(_invalidate_definition, sender=model, dispatch_uid="workflows.graph.%s.delete" % model.__name__)
+
+m2m_changed.connect(_invalidate_definition, sender=State.transitions.through,
+                    dispatch_uid="workflows.graph.transitions")
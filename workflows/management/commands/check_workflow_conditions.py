@@ -0,0 +1,35 @@
+# django imports
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+# workflows imports
+from workflows.conditions import check_conditions
+from workflows.models import Transition
+from workflows.models import Workflow
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks the conditions of all transitions and lists the invalid ones, "
+        "which are never fulfilled."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workflow", help="Name of the workflow whose transitions are checked.")
+
+    def handle(self, **options):
+        transitions = Transition.objects.exclude(condition="").order_by("workflow", "name")
+        if options["workflow"]:
+            try:
+                workflow = Workflow.objects.get(name=options["workflow"])
+            except Workflow.DoesNotExist:
+                raise CommandError("Unknown workflow '%s'." % options["workflow"])
+            transitions = transitions.filter(workflow=workflow)
+
+        invalid = check_conditions(transitions)
+        for transition, error in invalid:
+            self.stdout.write("%s: %s: %s" % (transition.workflow.name, transition.name, error))
+
+        if invalid:
+            raise CommandError("%s invalid conditions." % len(invalid))
+        self.stdout.write("All conditions are valid.")
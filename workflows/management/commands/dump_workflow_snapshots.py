@@ -0,0 +1,20 @@
+# django imports
+from django.core.management.base import BaseCommand
+
+# workflows imports
+from workflows.graph import dump_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the snapshots of all workflow definitions to the passed file. "
+        "Processes which have it set as WORKFLOWS_SNAPSHOT_FILE load their "
+        "workflow graphs without any query."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The file to write the snapshots to.")
+
+    def handle(self, **options):
+        dump_snapshots(options["path"])
+        self.stdout.write("Wrote workflow snapshots to %s." % options["path"])
@@ -0,0 +1,59 @@
+# django imports
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+# workflows imports
+from workflows.models import Workflow
+from workflows.utils import migrate_workflow
+
+
+class Command(BaseCommand):
+    help = (
+        "Replaces a workflow by another one and moves all objects into the "
+        "mapped states. Can be interrupted and resumed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("old_workflow", help="Name of the workflow which is replaced.")
+        parser.add_argument("new_workflow", help="Name of the workflow which replaces the old one.")
+        parser.add_argument(
+            "--map", action="append", dest="state_map", default=[], metavar="OLD=NEW",
+            help="Maps a state of the old workflow to a state of the new one. Repeat for every state.")
+        parser.add_argument(
+            "--content-type", dest="content_type", metavar="APP_LABEL.MODEL",
+            help="Only migrate this content type.")
+        parser.add_argument(
+            "--chunk-size", dest="chunk_size", type=int,
+            help="Amount of objects which are migrated within one transaction.")
+
+    def handle(self, **options):
+        state_map = {}
+        for mapping in options["state_map"]:
+            try:
+                old_state, new_state = mapping.split("=", 1)
+            except ValueError:
+                raise CommandError("Invalid state mapping '%s', use OLD=NEW." % mapping)
+            state_map[old_state.strip()] = new_state.strip()
+
+        ctype = None
+        if options["content_type"]:
+            try:
+                app_label, model = options["content_type"].split(".", 1)
+                ctype = ContentType.objects.get_by_natural_key(app_label, model.lower())
+            except (ValueError, ContentType.DoesNotExist):
+                raise CommandError("Unknown content type '%s'." % options["content_type"])
+
+        try:
+            migrated = migrate_workflow(
+                options["old_workflow"], options["new_workflow"], state_map, ctype=ctype,
+                chunk_size=options["chunk_size"], progress=self.progress)
+        except Workflow.DoesNotExist:
+            raise CommandError("Unknown workflow.")
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("Migrated %s objects." % migrated)
+
+    def progress(self, done, total):
+        self.stdout.write("%s / %s" % (done, total))
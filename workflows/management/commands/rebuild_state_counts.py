@@ -0,0 +1,25 @@
+# django imports
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+# workflows imports
+from workflows.models import Workflow
+from workflows.utils import rebuild_state_counts
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the objects per workflow state and content type and "
+        "replaces the maintained counters."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workflow", help="Name of the workflow whose counters are rebuilt.")
+
+    def handle(self, **options):
+        try:
+            count = rebuild_state_counts(options["workflow"])
+        except Workflow.DoesNotExist:
+            raise CommandError("Unknown workflow '%s'." % options["workflow"])
+
+        self.stdout.write("Rebuilt %s counters." % count)
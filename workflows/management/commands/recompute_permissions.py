@@ -0,0 +1,54 @@
+# django imports
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+# workflows imports
+from workflows.models import Workflow
+from workflows.utils import recompute_permissions
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the permissions of all objects of a workflow and / or a "
+        "content type according to their current workflow states."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workflow", help="Name of the workflow whose objects are processed.")
+        parser.add_argument(
+            "--content-type", dest="content_type", metavar="APP_LABEL.MODEL",
+            help="Only process this content type.")
+        parser.add_argument(
+            "--processes", type=int, default=1,
+            help="Amount of worker processes.")
+        parser.add_argument(
+            "--chunk-size", dest="chunk_size", type=int,
+            help="Amount of objects which are processed within one transaction.")
+        parser.add_argument(
+            "--dry-run", action="store_true", dest="dry_run", default=False,
+            help="Only count the affected objects.")
+
+    def handle(self, **options):
+        ctype = None
+        if options["content_type"]:
+            try:
+                app_label, model = options["content_type"].split(".", 1)
+                ctype = ContentType.objects.get_by_natural_key(app_label, model.lower())
+            except (ValueError, ContentType.DoesNotExist):
+                raise CommandError("Unknown content type '%s'." % options["content_type"])
+
+        try:
+            count = recompute_permissions(
+                options["workflow"], ctype, chunk_size=options["chunk_size"], processes=options["processes"],
+                progress=self.progress, dry_run=options["dry_run"])
+        except Workflow.DoesNotExist:
+            raise CommandError("Unknown workflow '%s'." % options["workflow"])
+
+        if options["dry_run"]:
+            self.stdout.write("%s objects would be processed." % count)
+        else:
+            self.stdout.write("Processed %s objects." % count)
+
+    def progress(self, done, total):
+        self.stdout.write("%s / %s" % (done, total))
@@ -0,0 +1,21 @@
+# django imports
+from django.core.management.base import BaseCommand
+
+# workflows imports
+from workflows.utils import run_scheduled_transitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Processes all due scheduled transitions. Can be run as a cronjob; "
+        "several instances can run in parallel."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", dest="batch_size", type=int,
+            help="Amount of transitions which are claimed at once.")
+
+    def handle(self, **options):
+        processed = run_scheduled_transitions(batch_size=options["batch_size"])
+        self.stdout.write("Processed %s scheduled transitions." % processed)
@@ -0,0 +1,144 @@
+# python imports
+import json
+import random
+from timeit import default_timer
+
+# django imports
+import django
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+from django.test.utils import CaptureQueriesContext
+
+# permissions imports
+import permissions.utils
+from permissions.models import Permission
+from permissions.models import Role
+
+# workflows imports
+import workflows.graph
+import workflows.utils
+from workflows.models import State
+from workflows.models import StateInheritanceBlock
+from workflows.models import StatePermissionRelation
+from workflows.models import Transition
+from workflows.models import Workflow
+from workflows.models import WorkflowPermissionRelation
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures wall time and queries of the workflow operations on "
+        "synthetic populations and prints the results as JSON. All data is "
+        "created within a transaction which is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", nargs="+", type=int, default=[10000, 100000, 1000000],
+            help="Amounts of objects to benchmark.")
+        parser.add_argument(
+            "--samples", type=int, default=100,
+            help="Amount of calls of the single object operations per size.")
+        parser.add_argument("--seed", type=int, default=0, help="Seed for the choice of sample objects.")
+        parser.add_argument("--output", help="File to write the results to (default: stdout).")
+
+    def handle(self, **options):
+        results = []
+        for size in options["sizes"]:
+            with transaction.atomic():
+                results.extend(self.run(size, options["samples"], random.Random(options["seed"])))
+                transaction.set_rollback(True)
+            workflows.graph.invalidate()
+
+        data = json.dumps({
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "results": results,
+        }, indent=4, sort_keys=True)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(data)
+        else:
+            self.stdout.write(data)
+
+    def run(self, size, samples, rand):
+        """Creates a workflow and a population of passed size and returns the
+        measurements.
+        """
+        results = []
+
+        def measure(operation, calls, func, *args):
+            with CaptureQueriesContext(connection) as queries:
+                start = default_timer()
+                for call_args in calls:
+                    func(*(args + call_args))
+                seconds = default_timer() - start
+            results.append({
+                "objects": size,
+                "operation": operation,
+                "calls": len(calls),
+                "seconds": round(seconds, 6),
+                "queries": len(queries),
+            })
+
+        role = Role.objects.get_or_create(name="workflows-benchmark")[0]
+        user = User.objects.get_or_create(username="workflows-benchmark")[0]
+        permissions.utils.add_role(user, role)
+        workflow, private, public, make_public, make_private = self.create_workflow(role)
+
+        Group.objects.bulk_create([Group(name="workflows-benchmark-%s" % i) for i in range(size)])
+        groups = Group.objects.filter(name__startswith="workflows-benchmark-")
+        ctype = ContentType.objects.get_for_model(Group)
+
+        workflows.utils.set_workflow_for_model(ctype, workflow)
+        measure("set_state_many", [()], workflows.utils.set_state_many, groups, private)
+
+        ids = list(groups.values_list("id", flat=True))
+        sample = [Group(id=id) for id in rand.sample(ids, min(samples, len(ids)))]
+
+        measure("get_state", [(obj,) for obj in sample], workflows.utils.get_state)
+        measure("get_allowed_transitions", [(obj, user) for obj in sample], workflows.utils.get_allowed_transitions)
+        measure("do_transition", [(obj, make_public, user) for obj in sample], workflows.utils.do_transition)
+        measure("set_state", [(obj, private) for obj in sample], workflows.utils.set_state)
+        measure("update_permissions", [(obj,) for obj in sample], workflows.utils.update_permissions)
+        measure("get_objects_for_workflow", [(workflow,)], workflows.utils.get_objects_for_workflow)
+        measure("remove_workflow_from_model", [(ctype,)], workflows.utils.remove_workflow_from_model)
+
+        return results
+
+    def create_workflow(self, role):
+        """Creates a workflow with two states, which manages two permissions
+        granted to passed role.
+        """
+        workflow = Workflow.objects.create(name="workflows-benchmark")
+        private = State.objects.create(name="Private", workflow=workflow)
+        public = State.objects.create(name="Public", workflow=workflow)
+
+        make_public = Transition.objects.create(name="Make public", workflow=workflow, destination=public)
+        make_private = Transition.objects.create(name="Make private", workflow=workflow, destination=private)
+        private.transitions.add(make_public)
+        public.transitions.add(make_private)
+
+        workflow.initial_state = private
+        workflow.save()
+
+        view = Permission.objects.get_or_create(
+            codename="workflows-benchmark-view", defaults={"name": "Benchmark view"})[0]
+        edit = Permission.objects.get_or_create(
+            codename="workflows-benchmark-edit", defaults={"name": "Benchmark edit"})[0]
+
+        for permission in (view, edit):
+            WorkflowPermissionRelation.objects.create(workflow=workflow, permission=permission)
+            StatePermissionRelation.objects.create(state=private, permission=permission, role=role)
+            StateInheritanceBlock.objects.create(state=private, permission=permission)
+        StatePermissionRelation.objects.create(state=public, permission=view, role=role)
+
+        make_public.permission = edit
+        make_public.save()
+
+        return workflow, private, public, make_public, make_private
@@ -0,0 +1,191 @@
+# python imports
+import functools
+import logging
+from timeit import default_timer
+
+# django imports
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.utils import CursorWrapper
+from django.db.models import Model
+from django.db.models.query import QuerySet
+
+# workflows imports
+from workflows.models import State
+from workflows.models import Transition
+from workflows.models import Workflow
+
+# Registered sinks
+_sinks = []
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsSink(object):
+    """Base class for metrics sinks. A sink receives a measurement for every
+    call of an instrumented workflow operation (see ``register_sink``).
+    The measurements are dropped unless ``record`` is overridden.
+
+    Nested operations (e.g. ``update_permissions`` called by ``set_state``)
+    are reported separately; the outer measurement includes the inner ones.
+    """
+    def record(self, operation, duration, queries, content_type, workflow_id):
+        """Records a single measurement. Does nothing by default. Must not
+        raise.
+
+        **Parameters:**
+
+        operation
+            The name of the operation, e.g. "set_state".
+
+        duration
+            The wall time of the operation in seconds.
+
+        queries
+            The amount of database queries of the operation.
+
+        content_type
+            The content type of the object or model the operation has been
+            called for. None if unknown.
+
+        workflow_id
+            The id of the workflow involved in the operation. None if it is
+            not known without further queries.
+        """
+
+
+def register_sink(sink):
+    """Registers the passed sink. As long as no sink is registered the
+    operations are not measured at all.
+
+    **Parameters:**
+
+    sink
+        A MetricsSink instance (or any object with a ``record`` method).
+    """
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def unregister_sink(sink):
+    """Unregisters the passed sink.
+    """
+    try:
+        _sinks.remove(sink)
+    except ValueError:
+        pass
+
+
+def instrument(operation):
+    """Decorator which reports the calls of the decorated function to the
+    registered sinks under the passed operation name.
+
+    The first argument of the function must be the object, the content type
+    or the model the operation is called for.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+
+            with _QueryCounter() as counter:
+                start = default_timer()
+                result = func(*args, **kwargs)
+                duration = default_timer() - start
+
+            content_type = _get_content_type(args[0]) if args else None
+            workflow_id = _get_workflow_id(list(args) + list(kwargs.values()) + [result])
+            for sink in list(_sinks):
+                try:
+                    sink.record(operation, duration, counter.count, content_type, workflow_id)
+                except Exception:
+                    # The operation has been done already and must not fail.
+                    logger.exception("Metrics sink %r failed to record %s.", sink, operation)
+
+            return result
+        return wrapper
+    return decorator
+
+
+# Private ####################################################################
+
+class _QueryCounter(object):
+    """Counts the queries of the default connection. Uses an execute wrapper
+    if Django provides them (2.0 or later), otherwise the cursors of the
+    connection are wrapped (see ``_CountingCursor``). The queries are neither
+    logged nor kept.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        if hasattr(connection, "execute_wrapper"):
+            self._context = connection.execute_wrapper(self)
+            self._context.__enter__()
+            return self
+
+        # The cursor method of the connection is replaced on the instance;
+        # the one of an outer counter (if any) is restored on exit.
+        self._context = None
+        self._connection = connections[DEFAULT_DB_ALIAS]
+        self._previous = self._connection.__dict__.get("cursor")
+        cursor = self._connection.cursor
+        self._connection.cursor = lambda: _CountingCursor(cursor(), self._connection, self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._context is not None:
+            self._context.__exit__(exc_type, exc_value, traceback)
+        elif self._previous is None:
+            del self._connection.cursor
+        else:
+            self._connection.cursor = self._previous
+
+
+class _CountingCursor(CursorWrapper):
+    """Wraps a cursor of a connection and counts its queries for the passed
+    _QueryCounter.
+    """
+    def __init__(self, cursor, db, counter):
+        super(_CountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter.count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+def _get_content_type(ctype_or_obj):
+    """Returns the content type of the passed object, model or queryset or the
+    passed content type itself. Content types are cached by Django.
+    """
+    if isinstance(ctype_or_obj, ContentType):
+        return ctype_or_obj
+    if isinstance(ctype_or_obj, QuerySet):
+        return ContentType.objects.get_for_model(ctype_or_obj.model)
+    if isinstance(ctype_or_obj, Model) or (isinstance(ctype_or_obj, type) and issubclass(ctype_or_obj, Model)):
+        return ContentType.objects.get_for_model(ctype_or_obj)
+    return None
+
+
+def _get_workflow_id(values):
+    """Returns the workflow id of the first workflow, state or transition
+    within the passed values (arguments and result of an operation).
+    """
+    for value in values:
+        if isinstance(value, Workflow):
+            return value.id
+        if isinstance(value, (State, Transition)):
+            return value.workflow_id
+    return None
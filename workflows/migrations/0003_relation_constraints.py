@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+from django.db.models import Max
+
+
+def remove_duplicates(apps, schema_editor):
+    """Removes all but the latest state per object and all but the latest
+    workflow per content type, which have been possible before.
+    """
+    StateObjectRelation = apps.get_model("workflows", "StateObjectRelation")
+    WorkflowModelRelation = apps.get_model("workflows", "WorkflowModelRelation")
+
+    duplicates = StateObjectRelation.objects.values("content_type", "content_id").annotate(
+        max_id=Max("id"), count=Count("id")).filter(count__gt=1)
+    for duplicate in duplicates:
+        StateObjectRelation.objects.filter(
+            content_type=duplicate["content_type"], content_id=duplicate["content_id"]).exclude(
+            id=duplicate["max_id"]).delete()
+
+    duplicates = WorkflowModelRelation.objects.values("content_type").annotate(
+        max_id=Max("id"), count=Count("id")).filter(count__gt=1)
+    for duplicate in duplicates:
+        WorkflowModelRelation.objects.filter(
+            content_type=duplicate["content_type"]).exclude(id=duplicate["max_id"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0002_stateobjectrelation_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='workflowmodelrelation',
+            name='content_type',
+            field=models.OneToOneField(verbose_name='Content Type', to='contenttypes.ContentType'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stateobjectrelation',
+            unique_together=set([('content_type', 'content_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='stateobjectrelation',
+            index_together=set([('content_type', 'state')]),
+        ),
+    ]
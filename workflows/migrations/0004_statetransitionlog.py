@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('workflows', '0003_relation_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateTransitionLog',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content_id', models.PositiveIntegerField(verbose_name='Content id')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Timestamp', db_index=True)),
+                ('content_type', models.ForeignKey(related_name='state_transition_logs', verbose_name='Content type', to='contenttypes.ContentType')),
+                ('from_state', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, verbose_name='From state', blank=True, to='workflows.State', null=True)),
+                ('to_state', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, verbose_name='To state', blank=True, to='workflows.State', null=True)),
+                ('transition', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, verbose_name='Transition', blank=True, to='workflows.Transition', null=True)),
+                ('user', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, verbose_name='User', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+                'ordering': ('timestamp', 'id'),
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='statetransitionlog',
+            index_together=set([('content_type', 'content_id', 'timestamp')]),
+        ),
+    ]
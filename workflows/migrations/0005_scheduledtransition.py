@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('workflows', '0004_statetransitionlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTransition',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content_id', models.PositiveIntegerField(verbose_name='Content id')),
+                ('due_at', models.DateTimeField(verbose_name='Due at', db_index=True)),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('last_error', models.TextField(verbose_name='Last error', blank=True)),
+                ('content_type', models.ForeignKey(related_name='scheduled_transitions', verbose_name='Content type', to='contenttypes.ContentType')),
+                ('transition', models.ForeignKey(related_name='+', verbose_name='Transition', to='workflows.Transition')),
+                ('user', models.ForeignKey(related_name='+', verbose_name='User', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+                'ordering': ('due_at', 'id'),
+            },
+        ),
+    ]
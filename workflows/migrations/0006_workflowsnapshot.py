@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0005_scheduledtransition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('generation', models.PositiveIntegerField(default=0, verbose_name='Generation')),
+                ('data', models.TextField(verbose_name='Data', blank=True)),
+                ('workflow', models.OneToOneField(related_name='snapshot', verbose_name='Workflow', to='workflows.Workflow')),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def fill_counts(apps, schema_editor):
+    """Counts the existing objects per state and content type.
+    """
+    StateObjectRelation = apps.get_model("workflows", "StateObjectRelation")
+    StateObjectCount = apps.get_model("workflows", "StateObjectCount")
+
+    rows = StateObjectRelation.objects.filter(content_type__isnull=False).values(
+        "state", "state__workflow", "content_type").annotate(total=Count("id"))
+    StateObjectCount.objects.bulk_create([
+        StateObjectCount(state_id=row["state"], workflow_id=row["state__workflow"],
+                         content_type_id=row["content_type"], count=row["total"])
+        for row in rows])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('workflows', '0006_workflowsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateObjectCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('count', models.IntegerField(default=0, verbose_name='Count')),
+                ('content_type', models.ForeignKey(related_name='+', verbose_name='Content type', to='contenttypes.ContentType')),
+                ('state', models.ForeignKey(related_name='object_counts', verbose_name='State', to='workflows.State')),
+                ('workflow', models.ForeignKey(related_name='state_counts', verbose_name='Workflow', to='workflows.Workflow')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='stateobjectcount',
+            unique_together=set([('state', 'content_type')]),
+        ),
+        migrations.RunPython(fill_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_snapshots(apps, schema_editor):
+    """Creates the (empty) snapshots which hold the generations of the
+    existing workflows.
+    """
+    Workflow = apps.get_model("workflows", "Workflow")
+    WorkflowSnapshot = apps.get_model("workflows", "WorkflowSnapshot")
+
+    WorkflowSnapshot.objects.bulk_create([
+        WorkflowSnapshot(workflow_id=workflow_id)
+        for workflow_id in Workflow.objects.filter(snapshot__isnull=True).values_list("id", flat=True)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0007_stateobjectcount'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_snapshots, migrations.RunPython.noop),
+    ]
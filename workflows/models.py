@@ -1,12 +1,14 @@
 from django.db import models
 
 # django imports
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 # permissions imports
-import permissions.utils
 from permissions.models import Permission
 from permissions.models import Role
 
@@ -61,24 +63,43 @@ class Workflow(models.Model):
         """Returns all objects which have this workflow assigned. Globally
         (via the object's content type) or locally (via the object itself).
         """
-        import workflows.utils
         objs = []
+        for queryset in self.get_querysets():
+            objs.extend(queryset)
+        return objs
 
-        # Get all objects whose content type has this workflow
-        for wmr in WorkflowModelRelation.objects.filter(workflow=self):
-            ctype = wmr.content_type
-            # We have also to check whether the global workflow is not
-            # overwritten.
-            for obj in ctype.model_class().objects.all():
-                if workflows.utils.get_workflow(obj) == self:
-                    objs.append(obj)
+    def get_querysets(self):
+        """Returns one lazy queryset per content type which contains all
+        objects which have this workflow assigned (see ``get_objects``).
 
-        # Get all objects whose local workflow this workflow
-        for wor in WorkflowObjectRelation.objects.filter(workflow=self):
-            if wor.content not in objs:
-                objs.append(wor.content)
+        The membership is resolved within the database: all instances of the
+        content types which have this workflow, except the ones which have
+        another workflow assigned locally, plus all instances which have this
+        workflow assigned locally.
+        """
+        querysets = []
 
-        return objs
+        # Get all objects whose content type has this workflow. We have also
+        # to exclude the objects whose global workflow is overwritten.
+        model_ctype_ids = set()
+        for wmr in WorkflowModelRelation.objects.filter(workflow=self).select_related("content_type"):
+            ctype = wmr.content_type
+            model_ctype_ids.add(ctype.id)
+            overwritten = WorkflowObjectRelation.objects.filter(
+                content_type=ctype, content_id__isnull=False).exclude(workflow=self).values("content_id")
+            querysets.append(ctype.model_class()._default_manager.exclude(pk__in=overwritten))
+
+        # Get all objects whose local workflow is this workflow. The ones of
+        # the content types above are already part of their querysets.
+        ctype_ids = WorkflowObjectRelation.objects.filter(workflow=self).exclude(
+            content_type__in=list(model_ctype_ids)).values_list("content_type", flat=True).distinct()
+        for ctype_id in ctype_ids:
+            ctype = ContentType.objects.get_for_id(ctype_id)
+            local = WorkflowObjectRelation.objects.filter(
+                content_type=ctype, workflow=self).values("content_id")
+            querysets.append(ctype.model_class()._default_manager.filter(pk__in=local))
+
+        return querysets
 
     def set_to(self, ctype_or_obj):
         """Sets the workflow to passed content type or object. See the specific
@@ -105,6 +126,8 @@ class Workflow(models.Model):
             The content type which gets the workflow. Can be any Django model
             instance.
         """
+        import workflows.cache
+
         try:
             wor = WorkflowModelRelation.objects.get(content_type=ctype)
         except WorkflowModelRelation.DoesNotExist:
@@ -112,6 +135,7 @@ class Workflow(models.Model):
         else:
             wor.workflow = self
             wor.save()
+        workflows.cache.set_model_workflow(ctype, self)
 
     def set_to_object(self, obj):
         """Sets the workflow to the passed object.
@@ -125,6 +149,7 @@ class Workflow(models.Model):
         obj
             The object which gets the workflow.
         """
+        import workflows.cache
         import workflows.utils
 
         ctype = ContentType.objects.get_for_model(obj)
@@ -132,12 +157,16 @@ class Workflow(models.Model):
             wor = WorkflowObjectRelation.objects.get(content_type=ctype, content_id=obj.id)
         except WorkflowObjectRelation.DoesNotExist:
             WorkflowObjectRelation.objects.create(content=obj, workflow=self)
+            workflows.cache.set_object_workflow(ctype, obj.id, self)
+            workflows.utils._update_prefetched(obj, workflow=self)
             workflows.utils.set_state(obj, self.initial_state)
         else:
             if wor.workflow != self:
                 wor.workflow = self
                 wor.save()
-                workflows.utils.set_state(self.initial_state)
+                workflows.cache.set_object_workflow(ctype, obj.id, self)
+                workflows.utils._update_prefetched(obj, workflow=self)
+                workflows.utils.set_state(obj, self.initial_state)
 
 
 class State(models.Model):
@@ -169,22 +198,19 @@ class State(models.Model):
     def get_allowed_transitions(self, obj, user):
         """Returns all allowed transitions for passed object and user.
         """
-        transitions = []
-        for transition in self.transitions.all():
-            permission = transition.permission
-            if permission is None:
-                transitions.append(transition)
-            else:
-                # First we try to get the objects specific has_permission
-                # method (in case the object inherits from the PermissionBase
-                # class).
-                try:
-                    if obj.has_permission(user, permission.codename):
-                        transitions.append(transition)
-                except AttributeError:
-                    if permissions.utils.has_permission(obj, user, permission.codename):
-                        transitions.append(transition)
-        return transitions
+        import workflows.conditions
+        import workflows.graph
+        import workflows.utils
+
+        transitions = workflows.graph.get_graph(self.workflow_id).get_transitions(self)
+
+        # The permissions of all transitions are checked at once.
+        codenames = set(t.permission.codename for t in transitions if t.permission is not None)
+        granted = workflows.utils._get_granted_codenames(obj, user, codenames)
+
+        return [t for t in transitions
+                if (t.permission is None or t.permission.codename in granted) and
+                workflows.conditions.evaluate(t, obj, user, self)]
 
 
 class Transition(models.Model):
@@ -205,8 +231,8 @@ class Transition(models.Model):
         instance.
 
     condition
-        The condition when the transition is available. Can be any python
-        expression.
+        The condition when the transition is available. Must be a restricted
+        python expression (see ``workflows.conditions``).
 
     permission
         The necessary permission to process the transition. Must be a
@@ -225,6 +251,16 @@ class Transition(models.Model):
     def __unicode__(self):
         return self.name
 
+    def clean(self):
+        """Validates the condition of the transition.
+        """
+        import workflows.conditions
+        if self.condition.strip():
+            try:
+                workflows.conditions.compile_condition(self.condition)
+            except workflows.conditions.ConditionError as e:
+                raise ValidationError({"condition": str(e)})
+
 
 class StateObjectRelation(models.Model):
     """Stores the workflow state of an object.
@@ -240,18 +276,56 @@ class StateObjectRelation(models.Model):
 
     state
         The state of content. This must be a State instance.
+
+    version
+        Is increased with every state change of the content. Used to detect
+        concurrent state changes.
     """
     content_type = models.ForeignKey(ContentType, verbose_name=_(u"Content type"), related_name="state_object", blank=True, null=True)
     content_id = models.PositiveIntegerField(_(u"Content id"), blank=True, null=True)
     content = GenericForeignKey(ct_field="content_type", fk_field="content_id")
     state = models.ForeignKey(State, verbose_name=_(u"State"))
+    version = models.PositiveIntegerField(_(u"Version"), default=0)
 
     def __unicode__(self):
         return "%s %s - %s" % (self.content_type.name, self.content_id, self.state.name)
 
     class Meta:
         app_label = "workflows"
-        unique_together = ("content_type", "content_id", "state")
+        unique_together = ("content_type", "content_id")
+        index_together = ("content_type", "state")
+
+
+class StateObjectCount(models.Model):
+    """Stores the amount of objects of a content type which are in a state.
+    It is maintained by the functions in ``workflows.utils`` which change
+    states and can be rebuilt with ``workflows.utils.rebuild_state_counts``.
+
+    **Attributes:**
+
+    workflow
+        The workflow of the state.
+
+    state
+        The state the objects are in.
+
+    content_type
+        The content type of the objects.
+
+    count
+        The amount of objects.
+    """
+    workflow = models.ForeignKey(Workflow, verbose_name=_(u"Workflow"), related_name="state_counts")
+    state = models.ForeignKey(State, verbose_name=_(u"State"), related_name="object_counts")
+    content_type = models.ForeignKey(ContentType, verbose_name=_(u"Content type"), related_name="+")
+    count = models.IntegerField(_(u"Count"), default=0)
+
+    class Meta:
+        app_label = "workflows"
+        unique_together = ("state", "content_type")
+
+    def __unicode__(self):
+        return "%s %s: %s" % (self.state.name, self.content_type.name, self.count)
 
 
 class WorkflowObjectRelation(models.Model):
@@ -298,7 +372,7 @@ class WorkflowModelRelation(models.Model):
         The workflow which is assigned to an object. This needs to be a
         workflow instance.
     """
-    content_type = models.ForeignKey(ContentType, verbose_name=_(u"Content Type"))
+    content_type = models.OneToOneField(ContentType, verbose_name=_(u"Content Type"))
     workflow = models.ForeignKey(Workflow, verbose_name=_(u"Workflow"), related_name="wmrs")
 
     class Meta:
@@ -308,6 +382,122 @@ class WorkflowModelRelation(models.Model):
         return "%s - %s" % (self.content_type.name, self.workflow.name)
 
 
+class StateTransitionLog(models.Model):
+    """Stores a state change of an object. The entries are only appended,
+    never changed.
+
+    **Attributes:**
+
+    content
+        The object whose state has been changed. This can be any instance of
+        a Django model.
+
+    from_state
+        The state of content before the change (None if it had no state).
+
+    to_state
+        The state of content after the change.
+
+    transition
+        The transition which has been processed (None if the state has been
+        set directly).
+
+    user
+        The user who processed the transition (if known).
+
+    timestamp
+        The date and time of the change.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_(u"Content type"), related_name="state_transition_logs")
+    content_id = models.PositiveIntegerField(_(u"Content id"))
+    content = GenericForeignKey(ct_field="content_type", fk_field="content_id")
+    from_state = models.ForeignKey(State, verbose_name=_(u"From state"), related_name="+", blank=True, null=True, on_delete=models.SET_NULL)
+    to_state = models.ForeignKey(State, verbose_name=_(u"To state"), related_name="+", blank=True, null=True, on_delete=models.SET_NULL)
+    transition = models.ForeignKey(Transition, verbose_name=_(u"Transition"), related_name="+", blank=True, null=True, on_delete=models.SET_NULL)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_(u"User"), related_name="+", blank=True, null=True, on_delete=models.SET_NULL)
+    timestamp = models.DateTimeField(_(u"Timestamp"), default=timezone.now, db_index=True)
+
+    class Meta:
+        app_label = "workflows"
+        ordering = ("timestamp", "id")
+        index_together = ("content_type", "content_id", "timestamp")
+
+    def __unicode__(self):
+        return "%s %s: %s -> %s" % (self.content_type.name, self.content_id,
+            self.from_state.name if self.from_state else None, self.to_state.name if self.to_state else None)
+
+
+class ScheduledTransition(models.Model):
+    """A transition which is processed automatically for an object when it is
+    due (see ``workflows.utils.run_scheduled_transitions``).
+
+    **Attributes:**
+
+    content
+        The object for which the transition is processed. This can be any
+        instance of a Django model.
+
+    transition
+        The transition which is processed.
+
+    user
+        The user on whose behalf the transition is processed. If None the
+        permission of the transition isn't checked.
+
+    due_at
+        The date and time from which on the transition is processed.
+
+    attempts
+        The amount of failed attempts to process the transition.
+
+    last_error
+        The error of the last failed attempt.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_(u"Content type"), related_name="scheduled_transitions")
+    content_id = models.PositiveIntegerField(_(u"Content id"))
+    content = GenericForeignKey(ct_field="content_type", fk_field="content_id")
+    transition = models.ForeignKey(Transition, verbose_name=_(u"Transition"), related_name="+")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_(u"User"), related_name="+", blank=True, null=True)
+    due_at = models.DateTimeField(_(u"Due at"), db_index=True)
+    attempts = models.PositiveIntegerField(_(u"Attempts"), default=0)
+    last_error = models.TextField(_(u"Last error"), blank=True)
+
+    class Meta:
+        app_label = "workflows"
+        ordering = ("due_at", "id")
+
+    def __unicode__(self):
+        return "%s %s: %s at %s" % (self.content_type.name, self.content_id, self.transition.name, self.due_at)
+
+
+class WorkflowSnapshot(models.Model):
+    """Stores the generation of a workflow definition, so that processes can
+    detect changes, and the serialized definition, so that its graph can be
+    loaded with a single query (see ``workflows.graph.get_graph``).
+
+    **Attributes:**
+
+    workflow
+        The workflow the snapshot belongs to.
+
+    generation
+        Is increased whenever the definition of the workflow changes.
+
+    data
+        The definition as JSON (see ``workflows.graph.get_definition``). Empty
+        if it has to be rebuilt or snapshots aren't used.
+    """
+    workflow = models.OneToOneField(Workflow, verbose_name=_(u"Workflow"), related_name="snapshot")
+    generation = models.PositiveIntegerField(_(u"Generation"), default=0)
+    data = models.TextField(_(u"Data"), blank=True)
+
+    class Meta:
+        app_label = "workflows"
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.workflow.name, self.generation)
+
+
 # Permissions relation #######################################################
 class WorkflowPermissionRelation(models.Model):
     """Stores the permissions for which a workflow is responsible.
@@ -0,0 +1,230 @@
+"""Incremental propagation of changed workflow permission definitions.
+
+If the ``WORKFLOWS_INCREMENTAL_PERMISSIONS`` setting is True, changes of
+StatePermissionRelation, StateInheritanceBlock and WorkflowPermissionRelation
+are applied to the permissions and inheritance blocks of exactly the objects
+which are in the affected states, with a few set-based statements. The result
+is the same as calling ``update_permissions`` for all these objects.
+"""
+# django imports
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_save
+
+# permissions imports
+from permissions.models import ObjectPermission
+from permissions.models import ObjectPermissionInheritanceBlock
+
+# workflows imports
+from workflows.models import State
+from workflows.models import StateInheritanceBlock
+from workflows.models import StateObjectRelation
+from workflows.models import StatePermissionRelation
+from workflows.models import WorkflowPermissionRelation
+
+# The attribute which keeps the former values of a changed relation
+_OLD_ATTR = "_workflows_old"
+
+
+def is_enabled():
+    """Returns True if the incremental propagation is enabled.
+    """
+    return getattr(settings, "WORKFLOWS_INCREMENTAL_PERMISSIONS", False)
+
+
+def grant_permission(state_id, role_id, permission_id):
+    """Adds the permission for the role to all objects in the passed state
+    which don't have it yet.
+    """
+    _insert_missing(ObjectPermission, state_id, {"role_id": role_id, "permission_id": permission_id})
+
+
+def revoke_permission(state_id, role_id, permission_id):
+    """Removes the permission for the role from all objects in the passed
+    state, if the permission is managed by the state's workflow and not
+    granted to the role by the state otherwise.
+    """
+    state = State.objects.get(pk=state_id)
+    if not _is_managed(state.workflow_id, permission_id):
+        return
+    if StatePermissionRelation.objects.filter(state=state_id, role=role_id, permission=permission_id).exists():
+        return
+
+    for ctype_id, content_ids in _get_objects(state_id):
+        ObjectPermission.objects.filter(
+            content_type=ctype_id, content_id__in=content_ids, role=role_id, permission=permission_id).delete()
+
+
+def add_block(state_id, permission_id):
+    """Adds the inheritance block for the permission to all objects in the
+    passed state which don't have it yet.
+    """
+    _insert_missing(ObjectPermissionInheritanceBlock, state_id, {"permission_id": permission_id})
+
+
+def remove_block(state_id, permission_id):
+    """Removes the inheritance block for the permission from all objects in
+    the passed state, if the permission is managed by the state's workflow
+    and not blocked by the state otherwise.
+    """
+    state = State.objects.get(pk=state_id)
+    if not _is_managed(state.workflow_id, permission_id):
+        return
+    if StateInheritanceBlock.objects.filter(state=state_id, permission=permission_id).exists():
+        return
+
+    for ctype_id, content_ids in _get_objects(state_id):
+        ObjectPermissionInheritanceBlock.objects.filter(
+            content_type=ctype_id, content_id__in=content_ids, permission=permission_id).delete()
+
+
+def manage_permission(workflow_id, permission_id):
+    """Removes the permission (for all roles which aren't granted it by the
+    state) and its inheritance block (if the state doesn't block it) from all
+    objects in the states of the passed workflow, as the workflow has become
+    responsible for the permission.
+    """
+    for state in State.objects.filter(workflow=workflow_id):
+        roles = StatePermissionRelation.objects.filter(
+            state=state, permission=permission_id).values_list("role", flat=True)
+        blocked = StateInheritanceBlock.objects.filter(state=state, permission=permission_id).exists()
+
+        for ctype_id, content_ids in _get_objects(state.id):
+            ObjectPermission.objects.filter(
+                content_type=ctype_id, content_id__in=content_ids, permission=permission_id).exclude(
+                role__in=list(roles)).delete()
+            if not blocked:
+                ObjectPermissionInheritanceBlock.objects.filter(
+                    content_type=ctype_id, content_id__in=content_ids, permission=permission_id).delete()
+
+
+# Private ####################################################################
+
+def _is_managed(workflow_id, permission_id):
+    """Returns True if the passed workflow is responsible for the passed
+    permission.
+    """
+    return WorkflowPermissionRelation.objects.filter(workflow=workflow_id, permission=permission_id).exists()
+
+
+def _get_objects(state_id):
+    """Returns the objects in the passed state as (content type id, subquery
+    of content ids) tuples.
+    """
+    sors = StateObjectRelation.objects.filter(state=state_id, content_id__isnull=False)
+    for ctype_id in sors.values_list("content_type", flat=True).distinct().order_by("content_type"):
+        yield ctype_id, sors.filter(content_type=ctype_id).values("content_id")
+
+
+def _insert_missing(model, state_id, values):
+    """Inserts a row of the passed model (ObjectPermission or
+    ObjectPermissionInheritanceBlock) with the passed values for every object
+    in the passed state which doesn't have such a row yet, with a single
+    INSERT ... SELECT.
+    """
+    qn = connection.ops.quote_name
+    columns = sorted(values.keys())
+
+    sql = "INSERT INTO %(table)s (%(columns)s, %(content_type_id)s, %(content_id)s) " \
+          "SELECT %(params)s, %(sor)s.%(sor_content_type_id)s, %(sor)s.%(sor_content_id)s FROM %(sor)s " \
+          "WHERE %(sor)s.%(state_id)s = %%s AND %(sor)s.%(sor_content_id)s IS NOT NULL AND NOT EXISTS (" \
+          "SELECT 1 FROM %(table)s WHERE %(conditions)s AND " \
+          "%(table)s.%(content_type_id)s = %(sor)s.%(sor_content_type_id)s AND " \
+          "%(table)s.%(content_id)s = %(sor)s.%(sor_content_id)s)"
+    sql = sql % {
+        "table": qn(model._meta.db_table),
+        "columns": ", ".join(qn(column) for column in columns),
+        "params": ", ".join(["%s"] * len(columns)),
+        "conditions": " AND ".join("%s.%s = %%s" % (qn(model._meta.db_table), qn(column)) for column in columns),
+        "content_type_id": qn(model._meta.get_field("content_type").column),
+        "content_id": qn(model._meta.get_field("content_id").column),
+        "sor": qn(StateObjectRelation._meta.db_table),
+        "sor_content_type_id": qn(StateObjectRelation._meta.get_field("content_type").column),
+        "sor_content_id": qn(StateObjectRelation._meta.get_field("content_id").column),
+        "state_id": qn(StateObjectRelation._meta.get_field("state").column),
+    }
+    params = [values[column] for column in columns] + [state_id] + [values[column] for column in columns]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def _remember_old(sender, instance, **kwargs):
+    """Keeps the former values of a changed relation, so that they can be
+    revoked after it has been saved.
+    """
+    if is_enabled() and instance.pk is not None:
+        instance.__dict__[_OLD_ATTR] = sender.objects.filter(pk=instance.pk).first()
+
+
+def _state_permission_saved(sender, instance, created, **kwargs):
+    """Applies a created or changed StatePermissionRelation.
+    """
+    if not is_enabled():
+        return
+    old = instance.__dict__.pop(_OLD_ATTR, None)
+    if old is None:
+        grant_permission(instance.state_id, instance.role_id, instance.permission_id)
+        return
+    with transaction.atomic():
+        revoke_permission(old.state_id, old.role_id, old.permission_id)
+        grant_permission(instance.state_id, instance.role_id, instance.permission_id)
+
+
+def _state_permission_deleted(sender, instance, **kwargs):
+    """Applies a deleted StatePermissionRelation.
+    """
+    if is_enabled():
+        with transaction.atomic():
+            revoke_permission(instance.state_id, instance.role_id, instance.permission_id)
+
+
+def _inheritance_block_saved(sender, instance, created, **kwargs):
+    """Applies a created or changed StateInheritanceBlock.
+    """
+    if not is_enabled():
+        return
+    old = instance.__dict__.pop(_OLD_ATTR, None)
+    if old is None:
+        add_block(instance.state_id, instance.permission_id)
+        return
+    with transaction.atomic():
+        remove_block(old.state_id, old.permission_id)
+        add_block(instance.state_id, instance.permission_id)
+
+
+def _inheritance_block_deleted(sender, instance, **kwargs):
+    """Applies a deleted StateInheritanceBlock.
+    """
+    if is_enabled():
+        with transaction.atomic():
+            remove_block(instance.state_id, instance.permission_id)
+
+
+def _workflow_permission_saved(sender, instance, created, **kwargs):
+    """Applies a created or changed WorkflowPermissionRelation.
+    """
+    # If a workflow isn't responsible for a permission anymore, the objects
+    # keep it (like with update_permissions), so the former values don't
+    # matter.
+    if is_enabled():
+        with transaction.atomic():
+            manage_permission(instance.workflow_id, instance.permission_id)
+
+
+for model in (StatePermissionRelation, StateInheritanceBlock):
+    pre_save.connect(_remember_old, sender=model, dispatch_uid="workflows.propagation.%s" % model.__name__)
+
+post_save.connect(_state_permission_saved, sender=StatePermissionRelation,
+                  dispatch_uid="workflows.propagation.spr.save")
+post_delete.connect(_state_permission_deleted, sender=StatePermissionRelation,
+                    dispatch_uid="workflows.propagation.spr.delete")
+post_save.connect(_inheritance_block_saved, sender=StateInheritanceBlock,
+                  dispatch_uid="workflows.propagation.sib.save")
+post_delete.connect(_inheritance_block_deleted, sender=StateInheritanceBlock,
+                    dispatch_uid="workflows.propagation.sib.delete")
+post_save.connect(_workflow_permission_saved, sender=WorkflowPermissionRelation,
+                  dispatch_uid="workflows.propagation.wpr.save")
@@ -1,24 +1,61 @@
+# python imports
+import importlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 # django imports
+from django.apps import apps
+from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.flatpages.models import FlatPage
 from django.test import TestCase
+from django.test import TransactionTestCase
 from django.contrib.auth.models import User
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
 from django.contrib.sessions.backends.file import SessionStore
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+from django.core.management.base import CommandError
 from django.core.handlers.wsgi import WSGIRequest
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 # workflows import
 import permissions.utils
+from permissions.models import ObjectPermission
+from permissions.models import ObjectPermissionInheritanceBlock
+from permissions.models import Permission
+import workflows.cache
+import workflows.conditions
+import workflows.graph
+import workflows.metrics
 import workflows.utils
+from workflows import WorkflowBase
+from workflows import WorkflowQuerySet
+from workflows.models import ScheduledTransition
 from workflows.models import State
 from workflows.models import StateInheritanceBlock
+from workflows.models import StateObjectCount
 from workflows.models import StatePermissionRelation
 from workflows.models import StateObjectRelation
+from workflows.models import StateTransitionLog
 from workflows.models import Transition
 from workflows.models import Workflow
 from workflows.models import WorkflowModelRelation
 from workflows.models import WorkflowObjectRelation
 from workflows.models import WorkflowPermissionRelation
+from workflows.models import WorkflowSnapshot
 
 class WorkflowTestCase(TestCase):
     """Tests a simple workflow without permissions.
@@ -154,6 +191,554 @@ class PermissionsTestCase(TestCase):
         result = workflows.utils.do_transition(self.page_1, wrong, self.user)
         self.assertEqual(result, False)
 
+    def test_update_permissions_delta(self):
+        """Only the difference between the old and the new state is written.
+        """
+        ops = dict(ObjectPermission.objects.values_list("permission", "id"))
+        self.assertEqual(set(ops.keys()), set([self.view.id, self.edit.id]))
+
+        # Nothing to change
+        with self.assertNumQueries(4):
+            workflows.utils.update_permissions(self.page_1)
+
+        workflows.utils.set_state(self.page_1, self.public)
+
+        # The view permission is shared by both states and kept
+        self.assertEqual(list(ObjectPermission.objects.values_list("permission", "id")), [(self.view.id, ops[self.view.id])])
+        self.assertEqual(list(ObjectPermissionInheritanceBlock.objects.values_list("permission", flat=True)), [self.edit.id])
+
+        # Permissions which aren't managed by the workflow are kept
+        publish = permissions.utils.register_permission("Publish", "publish")
+        permissions.utils.grant_permission(self.page_1, self.owner, publish)
+        workflows.utils.set_state(self.page_1, self.private)
+        result = permissions.utils.has_permission(self.page_1, self.user, "publish")
+        self.assertEqual(result, True)
+
+    def test_transition_log(self):
+        """
+        """
+        workflows.utils.do_transition(self.page_1, self.make_public, self.user)
+        workflows.utils.set_state(self.page_1, self.private)
+
+        logs = StateTransitionLog.objects.all()
+        self.assertEqual([(l.content, l.from_state, l.to_state, l.transition, l.user) for l in logs], [
+            (self.page_1, None, self.private, None, None),
+            (self.page_1, self.private, self.public, self.make_public, self.user),
+            (self.page_1, self.public, self.private, None, None),
+        ])
+
+        page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        workflows.utils.set_state_many([self.page_1, page_2], self.public)
+
+        logs = StateTransitionLog.objects.filter(to_state=self.public, transition=None)
+        self.assertEqual(sorted((l.content_id, l.from_state_id) for l in logs),
+                         [(self.page_1.id, self.private.id), (page_2.id, None)])
+
+    def test_transition_log_batch(self):
+        """Within a batch all entries are written with one insert.
+        """
+        page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        workflows.utils.set_workflow(page_2, self.w)
+        count = StateTransitionLog.objects.count()
+
+        with CaptureQueriesContext(connection) as queries:
+            with workflows.utils.batch():
+                workflows.utils.do_transition(self.page_1, self.make_public, self.user)
+                with workflows.utils.batch():
+                    workflows.utils.do_transition(page_2, self.make_public, self.user)
+                self.assertEqual(StateTransitionLog.objects.count(), count)
+
+        inserts = [q for q in queries if "INSERT INTO \"workflows_statetransitionlog\"" in q["sql"]]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(StateTransitionLog.objects.count(), count + 2)
+
+        # Entries of rolled back batches are discarded
+        with workflows.utils.batch():
+            try:
+                with workflows.utils.batch():
+                    workflows.utils.do_transition(page_2, self.make_private, self.user)
+                    raise ValueError
+            except ValueError:
+                pass
+            workflows.utils.do_transition(self.page_1, self.make_private, self.user)
+
+        self.assertEqual(StateTransitionLog.objects.count(), count + 3)
+        self.assertEqual(workflows.utils.get_state(page_2), self.public)
+
+    def test_transition_log_admin(self):
+        """
+        """
+        log_admin = admin.site._registry[StateTransitionLog]
+        self.assertEqual(log_admin.has_add_permission(None), False)
+        self.assertEqual(log_admin.has_delete_permission(None), False)
+        self.assertEqual(set(log_admin.get_readonly_fields(None)), set(log_admin.fields))
+
+    def test_set_state_many(self):
+        """
+        """
+        page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        page_3 = FlatPage.objects.create(url="/page-3/", title="Page 3")
+        workflows.utils.set_workflow(page_2, self.w)
+
+        workflows.utils.set_state_many(FlatPage.objects.all(), self.public, chunk_size=2)
+
+        for page in (self.page_1, page_2, page_3):
+            self.assertEqual(workflows.utils.get_state(page), self.public)
+
+            result = permissions.utils.has_permission(page, self.user, "edit")
+            self.assertEqual(result, False)
+
+            result = permissions.utils.has_permission(page, self.user, "view")
+            self.assertEqual(result, True)
+
+            result = permissions.utils.is_inherited(page, "view")
+            self.assertEqual(result, True)
+
+            result = permissions.utils.is_inherited(page, "edit")
+            self.assertEqual(result, False)
+
+        self.assertEqual(StateObjectRelation.objects.count(), 3)
+
+        # Back to private, passed as list
+        workflows.utils.set_state_many([self.page_1, page_2], self.private)
+
+        result = permissions.utils.has_permission(self.page_1, self.user, "edit")
+        self.assertEqual(result, True)
+
+        result = permissions.utils.has_permission(page_3, self.user, "edit")
+        self.assertEqual(result, False)
+
+    def test_set_state_many_queries(self):
+        """The amount of queries doesn't depend on the amount of objects.
+        """
+        for i in range(10):
+            FlatPage.objects.create(url="/page-%s/" % (i + 2), title="Page")
+
+        # Including the update of the object counts (and the seeding of the
+        # counter of the new state)
+        with self.assertNumQueries(19):
+            workflows.utils.set_state_many(FlatPage.objects.all(), self.public)
+
+    def test_do_transition_concurrent(self):
+        """Only the first of concurrent transitions is processed.
+        """
+        version = workflows.utils.get_state_version(self.page_1)
+
+        # Another process sees the object in the same state
+        page_1 = FlatPage.objects.get(pk=self.page_1.pk)
+        workflows.utils.prefetch_workflow_states([page_1])
+
+        result = workflows.utils.do_transition(self.page_1, self.make_public, self.user, version=version)
+        self.assertEqual(result, True)
+        self.assertEqual(workflows.utils.get_state_version(self.page_1), version + 1)
+
+        result = workflows.utils.do_transition(page_1, self.make_public, self.user)
+        self.assertEqual(result, False)
+
+        # Outdated version
+        result = workflows.utils.do_transition(self.page_1, self.make_private, self.user, version=version)
+        self.assertEqual(result, False)
+
+        state = workflows.utils.get_state(self.page_1)
+        self.assertEqual(state, self.public)
+
+    def test_migrate_workflow(self):
+        """
+        """
+        page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        page_3 = FlatPage.objects.create(url="/page-3/", title="Page 3")
+        ctype = ContentType.objects.get_for_model(FlatPage)
+        workflows.utils.set_workflow(ctype, self.w)
+        workflows.utils.set_state_many([page_2, page_3], self.public)
+
+        w2 = Workflow.objects.create(name="Review")
+        draft = State.objects.create(name="Draft", workflow=w2)
+        published = State.objects.create(name="Published", workflow=w2)
+        WorkflowPermissionRelation.objects.create(workflow=w2, permission=self.view)
+        StatePermissionRelation.objects.create(state=published, permission=self.view, role=self.owner)
+
+        self.assertRaises(ValueError, workflows.utils.migrate_workflow, self.w, w2, {"Private": "Draft"})
+
+        calls = []
+        result = workflows.utils.migrate_workflow(
+            self.w, w2, {self.private: draft, "Public": "Published"}, chunk_size=2,
+            progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(result, 3)
+        self.assertEqual(calls, [(2, 3), (3, 3)])
+
+        self.assertEqual(workflows.utils.get_workflow_for_model(ctype), w2)
+        self.assertEqual(workflows.utils.get_workflow(self.page_1), w2)
+        self.assertEqual(workflows.utils.get_state(self.page_1), draft)
+        self.assertEqual(workflows.utils.get_state(page_2), published)
+
+        # Permissions managed by the old workflow only are removed
+        self.assertEqual(permissions.utils.has_permission(self.page_1, self.user, "edit"), False)
+        self.assertEqual(permissions.utils.has_permission(self.page_1, self.user, "view"), False)
+        self.assertEqual(permissions.utils.has_permission(page_2, self.user, "view"), True)
+        self.assertEqual(permissions.utils.is_inherited(page_2, "edit"), True)
+
+        # Nothing left to migrate on resume
+        self.assertEqual(workflows.utils.migrate_workflow(self.w, w2, {"Private": "Draft", "Public": "Published"}), 0)
+
+    def test_migrate_workflow_command(self):
+        """
+        """
+        w2 = Workflow.objects.create(name="Review")
+        draft = State.objects.create(name="Draft", workflow=w2)
+
+        out = StringIO()
+        call_command("migrate_workflow", "Standard", "Review", "--map", "Private=Draft",
+                     "--map", "Public=Draft", "--content-type", "flatpages.flatpage", stdout=out)
+        self.assertEqual(workflows.utils.get_state(self.page_1), draft)
+        self.assertIn("Migrated 1 objects.", out.getvalue())
+
+        self.assertRaises(CommandError, call_command, "migrate_workflow", "Standard", "Review",
+                          "--map", "Private")
+
+class BenchmarkTestCase(TestCase):
+    """Tests the benchmark command.
+    """
+    def test_benchmark(self):
+        """
+        """
+        out = StringIO()
+        call_command("workflows_benchmark", "--sizes", "5", "--samples", "2", stdout=out)
+        data = json.loads(out.getvalue())
+
+        self.assertEqual(data["database"], "sqlite")
+        self.assertEqual(set(r["operation"] for r in data["results"]), set([
+            "set_state_many", "get_state", "get_allowed_transitions", "do_transition", "set_state",
+            "update_permissions", "get_objects_for_workflow", "remove_workflow_from_model"]))
+        self.assertEqual(data["results"][1]["calls"], 2)
+
+        # All data is rolled back
+        self.assertEqual(Workflow.objects.filter(name="workflows-benchmark").count(), 0)
+        self.assertEqual(StateObjectRelation.objects.count(), 0)
+
+class MetricsTestCase(TestCase):
+    """Tests the metrics sinks.
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        self.records = []
+
+        class Sink(workflows.metrics.MetricsSink):
+            def record(sink, *args):
+                self.records.append(args)
+
+        self.sink = Sink()
+        workflows.metrics.register_sink(self.sink)
+
+    def tearDown(self):
+        """
+        """
+        workflows.metrics.unregister_sink(self.sink)
+
+    def test_record(self):
+        """
+        """
+        ctype = ContentType.objects.get_for_model(self.page_1)
+        workflows.utils.set_workflow(self.page_1, self.w)
+        # Nested operations are reported before the outer ones
+        self.assertEqual([r[0] for r in self.records], ["get_state", "update_permissions", "set_state", "set_workflow"])
+
+        del self.records[:]
+        with self.assertNumQueries(1):
+            workflows.utils.get_state(self.page_1)
+
+        operation, duration, queries, content_type, workflow_id = self.records[0]
+        self.assertEqual((operation, queries, content_type, workflow_id), ("get_state", 1, ctype, self.w.id))
+        self.assertTrue(duration >= 0)
+
+    def test_unregister(self):
+        """
+        """
+        workflows.metrics.unregister_sink(self.sink)
+        workflows.utils.get_state(self.page_1)
+        self.assertEqual(self.records, [])
+
+    def test_full_query_log(self):
+        """
+        """
+        workflows.utils.set_workflow(self.page_1, self.w)
+        del self.records[:]
+
+        # The queries are counted independent of the debug query log
+        queries_log = connection.queries_log
+        queries_log.extend([{}] * queries_log.maxlen)
+        try:
+            with self.settings(DEBUG=True):
+                workflows.utils.get_state(self.page_1)
+        finally:
+            queries_log.clear()
+        self.assertEqual(self.records[0][2], 1)
+
+    def test_failing_sink(self):
+        """
+        """
+        class Sink(workflows.metrics.MetricsSink):
+            def record(self, *args):
+                raise ValueError("Boom")
+
+        errors = []
+        handler = logging.Handler()
+        handler.emit = errors.append
+        logger = logging.getLogger("workflows.metrics")
+        logger.addHandler(handler)
+        sink = Sink()
+        workflows.metrics.register_sink(sink)
+        try:
+            workflows.utils.set_workflow(self.page_1, self.w)
+        finally:
+            workflows.metrics.unregister_sink(sink)
+            logger.removeHandler(handler)
+
+        # The operation is done and the error logged
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(errors[0].exc_info[0], ValueError)
+
+        # Other sinks still receive the measurements
+        self.assertEqual([r[0] for r in self.records[:4]], ["get_state", "update_permissions", "set_state", "set_workflow"])
+
+    def test_base_sink(self):
+        """
+        """
+        sink = workflows.metrics.MetricsSink()
+        workflows.metrics.register_sink(sink)
+        try:
+            self.assertEqual(workflows.utils.get_state(self.page_1), None)
+        finally:
+            workflows.metrics.unregister_sink(sink)
+
+class ScheduledTransitionTestCase(TestCase):
+    """Tests scheduled transitions.
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        self.page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        workflows.utils.set_workflow(self.page_1, self.w)
+        workflows.utils.set_workflow(self.page_2, self.w)
+        self.now = timezone.now()
+
+    def test_run(self):
+        """
+        """
+        workflows.utils.schedule_transition(self.page_1, self.make_public, self.now)
+        workflows.utils.schedule_transition(self.page_2, self.make_public, self.now + timedelta(days=1))
+        # Not applicable in state private
+        workflows.utils.schedule_transition(self.page_1, self.make_private, self.now - timedelta(days=1))
+
+        result = workflows.utils.run_scheduled_transitions(now=self.now, batch_size=1)
+        self.assertEqual(result, 2)
+
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.public)
+        self.assertEqual(workflows.utils.get_state(self.page_2), self.private)
+        self.assertEqual(list(ScheduledTransition.objects.values_list("content_id", flat=True)), [self.page_2.id])
+
+        ScheduledTransition.objects.update(due_at=self.now)
+        out = StringIO()
+        call_command("run_scheduled_transitions", stdout=out)
+        self.assertEqual(workflows.utils.get_state(self.page_2), self.public)
+        self.assertIn("Processed 1 scheduled transitions.", out.getvalue())
+
+    def test_permission(self):
+        """
+        """
+        user = User.objects.create(username="john")
+        edit = permissions.utils.register_permission("Edit", "edit")
+        self.make_public.permission = edit
+        self.make_public.save()
+
+        workflows.utils.schedule_transition(self.page_1, self.make_public, self.now, user=user)
+        workflows.utils.schedule_transition(self.page_2, self.make_public, self.now)
+        workflows.utils.run_scheduled_transitions(now=self.now)
+
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+        self.assertEqual(workflows.utils.get_state(self.page_2), self.public)
+        self.assertEqual(ScheduledTransition.objects.count(), 0)
+
+    def test_retry(self):
+        """
+        """
+        workflows.utils.schedule_transition(self.page_1, self.make_public, self.now)
+
+        def update_permissions(obj):
+            raise ValueError("Boom")
+
+        original, workflows.utils.update_permissions = workflows.utils.update_permissions, update_permissions
+        try:
+            result = workflows.utils.run_scheduled_transitions(now=self.now)
+        finally:
+            workflows.utils.update_permissions = original
+        self.assertEqual(result, 1)
+
+        # The state change is rolled back and the transition rescheduled
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+        st = ScheduledTransition.objects.get()
+        self.assertEqual((st.attempts, st.due_at, st.last_error), (1, self.now + timedelta(minutes=1), "ValueError: Boom"))
+
+        workflows.utils.run_scheduled_transitions(now=st.due_at)
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.public)
+        self.assertEqual(ScheduledTransition.objects.count(), 0)
+
+    def test_claim(self):
+        """
+        """
+        st = workflows.utils.schedule_transition(self.page_1, self.make_public, self.now)
+
+        # Claimed by another runner meanwhile
+        original = ScheduledTransition.objects.filter
+        def filter(*args, **kwargs):
+            if "due_at" in kwargs:
+                original(pk=st.pk).update(due_at=self.now + timedelta(seconds=600))
+            return original(*args, **kwargs)
+
+        ScheduledTransition.objects.filter = filter
+        try:
+            self.assertEqual(workflows.utils.run_scheduled_transitions(now=self.now), 0)
+        finally:
+            del ScheduledTransition.objects.filter
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+
+        # No rows are locked; the transition is due again after the lease
+        with self.settings(WORKFLOWS_SCHEDULED_TRANSITION_LEASE=60):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(workflows.utils.run_scheduled_transitions(now=self.now + timedelta(seconds=600)), 1)
+        self.assertFalse([q for q in queries.captured_queries if "FOR UPDATE" in q["sql"]])
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.public)
+        self.assertEqual(ScheduledTransition.objects.count(), 0)
+
+    def test_removed_transition(self):
+        """
+        """
+        workflows.utils.schedule_transition(self.page_1, self.make_public, self.now)
+        self.private.transitions.remove(self.make_public)
+
+        self.assertEqual(workflows.utils.run_scheduled_transitions(now=self.now), 1)
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+        self.assertEqual(ScheduledTransition.objects.count(), 0)
+
+class RecomputePermissionsTestCase(TestCase):
+    """Tests the recomputation of permissions.
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.owner = permissions.utils.register_role("Owner")
+        self.view = permissions.utils.register_permission("View", "view")
+        WorkflowPermissionRelation.objects.create(workflow=self.w, permission=self.view)
+
+        self.pages = [FlatPage.objects.create(url="/page-%s/" % i, title="Page") for i in range(5)]
+        ctype = ContentType.objects.get_for_model(FlatPage)
+        workflows.utils.set_workflow(ctype, self.w)
+        workflows.utils.set_state_many(self.pages, self.private)
+        workflows.utils.set_state(self.pages[0], self.public)
+
+    def test_recompute_permissions(self):
+        """
+        """
+        # Changed definition
+        StatePermissionRelation.objects.create(state=self.private, permission=self.view, role=self.owner)
+        self.assertEqual(ObjectPermission.objects.count(), 0)
+
+        calls = []
+        result = workflows.utils.recompute_permissions(
+            self.w, chunk_size=2, progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(result, 5)
+        self.assertEqual(calls, [(2, 5), (4, 5), (5, 5)])
+
+        self.assertEqual(sorted(ObjectPermission.objects.values_list("content_id", flat=True)),
+                         [page.id for page in self.pages[1:]])
+
+    def test_dry_run(self):
+        """
+        """
+        StatePermissionRelation.objects.create(state=self.private, permission=self.view, role=self.owner)
+
+        out = StringIO()
+        call_command("recompute_permissions", "--workflow", "Standard", "--dry-run", stdout=out)
+        self.assertIn("5 objects would be processed.", out.getvalue())
+        self.assertEqual(ObjectPermission.objects.count(), 0)
+
+        call_command("recompute_permissions", "--content-type", "flatpages.flatpage", stdout=out)
+        self.assertEqual(ObjectPermission.objects.count(), 4)
+
+class PropagationTestCase(TestCase):
+    """Tests the incremental propagation of changed permission definitions.
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.owner = permissions.utils.register_role("Owner")
+        self.reader = permissions.utils.register_role("Reader")
+        self.view = permissions.utils.register_permission("View", "view")
+        self.edit = permissions.utils.register_permission("Edit", "edit")
+        WorkflowPermissionRelation.objects.create(workflow=self.w, permission=self.view)
+        StatePermissionRelation.objects.create(state=self.private, permission=self.view, role=self.owner)
+
+        self.pages = [FlatPage.objects.create(url="/page-%s/" % i, title="Page") for i in range(4)]
+        workflows.utils.set_workflow(ContentType.objects.get_for_model(FlatPage), self.w)
+        workflows.utils.set_state_many(self.pages[:2], self.private)
+        workflows.utils.set_state_many(self.pages[2:], self.public)
+
+    def get_permissions(self):
+        return sorted(ObjectPermission.objects.values_list("content_id", "role", "permission")), \
+            sorted(ObjectPermissionInheritanceBlock.objects.values_list("content_id", "permission"))
+
+    def assertPropagated(self):
+        """The permissions equal the ones of a full recomputation.
+        """
+        result = self.get_permissions()
+        workflows.utils.recompute_permissions(self.w)
+        self.assertEqual(result, self.get_permissions())
+
+    def test_propagation(self):
+        """
+        """
+        with self.settings(WORKFLOWS_INCREMENTAL_PERMISSIONS=True):
+            # Insert of the relation and the permissions, generation update
+            with self.assertNumQueries(3):
+                spr = StatePermissionRelation.objects.create(state=self.public, permission=self.view, role=self.reader)
+            self.assertEqual(ObjectPermission.objects.filter(role=self.reader).count(), 2)
+            self.assertPropagated()
+
+            spr.state = self.private
+            spr.save()
+            self.assertEqual(sorted(ObjectPermission.objects.filter(role=self.reader).values_list("content_id", flat=True)),
+                             [self.pages[0].id, self.pages[1].id])
+            self.assertPropagated()
+
+            spr.delete()
+            self.assertEqual(ObjectPermission.objects.filter(role=self.reader).count(), 0)
+            self.assertPropagated()
+
+            sib = StateInheritanceBlock.objects.create(state=self.public, permission=self.view)
+            self.assertEqual(ObjectPermissionInheritanceBlock.objects.count(), 2)
+            self.assertPropagated()
+            sib.delete()
+            self.assertEqual(ObjectPermissionInheritanceBlock.objects.count(), 0)
+
+            # The edit permission isn't managed by the workflow yet
+            permissions.utils.grant_permission(self.pages[0], self.reader, self.edit)
+            WorkflowPermissionRelation.objects.create(workflow=self.w, permission=self.edit)
+            self.assertEqual(ObjectPermission.objects.filter(permission=self.edit).count(), 0)
+            self.assertPropagated()
+
+    def test_disabled(self):
+        """
+        """
+        StatePermissionRelation.objects.create(state=self.public, permission=self.view, role=self.reader)
+        self.assertEqual(ObjectPermission.objects.filter(role=self.reader).count(), 0)
+
 class UtilsTestCase(TestCase):
     """Tests various methods of the utils module.
     """
@@ -293,6 +878,106 @@ class UtilsTestCase(TestCase):
         result = workflows.utils.get_objects_for_workflow("Wrong")
         self.assertEqual(result, [])
 
+    def test_get_objects_for_workflow_5(self):
+        """Objects with another local workflow are excluded.
+        """
+        ctype = ContentType.objects.get_for_model(self.user)
+        user_2 = User.objects.create(username="jane")
+        wp = Workflow.objects.create(name="Portal")
+        wp.initial_state = State.objects.create(name="Draft", workflow=wp)
+        wp.save()
+
+        workflows.utils.set_workflow(ctype, self.w)
+        workflows.utils.set_workflow(user_2, wp)
+
+        result = workflows.utils.get_objects_for_workflow(self.w)
+        self.assertEqual(result, [self.user])
+
+        result = workflows.utils.get_objects_for_workflow(wp)
+        self.assertEqual(result, [user_2])
+
+    def test_get_objects_for_workflow_as_queryset(self):
+        """
+        """
+        result = workflows.utils.get_objects_for_workflow(self.w, as_queryset=True)
+        self.assertEqual(result, [])
+
+        page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        workflows.utils.set_workflow(page_1, self.w)
+
+        ctype = ContentType.objects.get_for_model(self.user)
+        workflows.utils.set_workflow(ctype, self.w)
+
+        result = workflows.utils.get_objects_for_workflow(self.w, as_queryset=True)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(list(result[0]), [self.user])
+        self.assertEqual(list(result[1]), [page_1])
+
+    def test_prefetch_workflow_states(self):
+        """
+        """
+        ctype = ContentType.objects.get_for_model(self.user)
+        workflows.utils.set_workflow(ctype, self.w)
+        workflows.utils.set_state(self.user, self.public)
+
+        user_2 = User.objects.create(username="jane")
+        page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        workflows.utils.set_workflow(page_1, self.w)
+
+        objs = [User.objects.get(pk=self.user.pk), User.objects.get(pk=user_2.pk), FlatPage.objects.get(pk=page_1.pk)]
+        with self.assertNumQueries(5):
+            workflows.utils.prefetch_workflow_states(objs)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(workflows.utils.get_workflow(objs[0]), self.w)
+            self.assertEqual(workflows.utils.get_state(objs[0]), self.public)
+            self.assertEqual(workflows.utils.get_workflow(objs[1]), self.w)
+            self.assertEqual(workflows.utils.get_state(objs[1]), None)
+            self.assertEqual(workflows.utils.get_workflow(objs[2]), self.w)
+            self.assertEqual(workflows.utils.get_state(objs[2]), self.private)
+
+        # The prefetched state is updated
+        workflows.utils.set_state(objs[2], self.public)
+        with self.assertNumQueries(0):
+            self.assertEqual(workflows.utils.get_state(objs[2]), self.public)
+
+    def test_prefetch_workflow_states_queryset(self):
+        """
+        """
+        page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        workflows.utils.set_workflow(page_1, self.w)
+
+        pages = list(WorkflowQuerySet(FlatPage).prefetch_workflow_states())
+        with self.assertNumQueries(0):
+            self.assertEqual(workflows.utils.get_workflow(pages[0]), self.w)
+            self.assertEqual(workflows.utils.get_state(pages[0]), self.private)
+
+    def test_queryset_in_state(self):
+        """
+        """
+        page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        page_3 = FlatPage.objects.create(url="/page-3/", title="Page 3")
+
+        workflows.utils.set_workflow(page_1, self.w)
+        workflows.utils.set_workflow(page_2, self.w)
+        workflows.utils.set_state(page_2, self.public)
+
+        pages = WorkflowQuerySet(FlatPage)
+        self.assertEqual(list(pages.in_state(self.private)), [page_1])
+        self.assertEqual(list(pages.in_state("Public")), [page_2])
+        self.assertEqual(list(pages.exclude_state(self.private)), [page_2, page_3])
+        self.assertEqual(list(pages.exclude_state("Public").exclude_state("Private")), [page_3])
+
+        # Other content types are not taken into account
+        workflows.utils.set_workflow(self.user, self.w)
+        self.assertEqual(list(pages.in_state(self.private)), [page_1])
+
+        with self.assertNumQueries(1):
+            pages = list(pages.annotate_state())
+        self.assertEqual([(p.workflow_state_id, p.workflow_state_name) for p in pages],
+                         [(self.private.id, "Private"), (self.public.id, "Public"), (None, None)])
+
     def test_remove_workflow_from_model(self):
         """
         """
@@ -317,6 +1002,30 @@ class UtilsTestCase(TestCase):
         result = workflows.utils.get_workflow_for_object(self.user)
         self.assertEqual(result, None)
 
+    def test_remove_workflow_from_model_bulk(self):
+        """Only the instances without an own workflow lose states and
+        permissions.
+        """
+        ctype = ContentType.objects.get_for_model(self.user)
+        user_2 = User.objects.create(username="jane")
+        user_3 = User.objects.create(username="jim")
+
+        role = permissions.utils.register_role("Owner")
+        permission = permissions.utils.register_permission("View", "view")
+        for user in (self.user, user_2, user_3):
+            permissions.utils.grant_permission(user, role, permission)
+
+        workflows.utils.set_workflow_for_model(ctype, self.w)
+        workflows.utils.set_state_many([self.user, user_2, user_3], self.private)
+        workflows.utils.set_workflow_for_object(user_3, self.w)
+
+        workflows.utils.remove_workflow_from_model(ctype, chunk_size=1)
+
+        self.assertEqual(workflows.utils.get_workflow_for_model(ctype), None)
+        self.assertEqual(list(StateObjectRelation.objects.values_list("content_id", flat=True)), [user_3.id])
+        self.assertEqual(list(ObjectPermission.objects.filter(
+            content_type=ctype).values_list("content_id", flat=True)), [user_3.id])
+
     def test_remove_workflow_from_object(self):
         """
         """
@@ -480,6 +1189,33 @@ class StateTestCase(TestCase):
         transitions = self.private.get_allowed_transitions(self.page_1, self.user)
         self.assertEqual(len(transitions), 1)
 
+    def test_get_allowed_transitions_queries(self):
+        """The permissions of all transitions are checked at once.
+        """
+        publish = permissions.utils.register_permission("Publish", "publish")
+        review = permissions.utils.register_permission("Review", "review")
+        archive = permissions.utils.register_permission("Archive", "archive")
+
+        for name, permission in (("Publish", publish), ("Review", review), ("Archive", archive)):
+            transition = Transition.objects.create(name=name, workflow=self.w, destination=self.public, permission=permission)
+            self.private.transitions.add(transition)
+
+        permissions.utils.grant_permission(self.page_1, self.role_1, publish)
+        permissions.utils.grant_permission(self.page_1, self.role_1, archive)
+
+        # Build the graph and cache the user's roles
+        self.private.get_allowed_transitions(self.page_1, self.user)
+
+        with self.assertNumQueries(2):
+            transitions = self.private.get_allowed_transitions(self.page_1, self.user)
+        self.assertEqual([t.name for t in transitions], ["Make public", "Publish", "Archive"])
+
+        # Superusers have all permissions
+        self.user.is_superuser = True
+        with self.assertNumQueries(0):
+            transitions = self.private.get_allowed_transitions(self.page_1, self.user)
+        self.assertEqual(len(transitions), 4)
+
 class TransitionTestCase(TestCase):
     """Tests the Transition model
     """
@@ -493,6 +1229,751 @@ class TransitionTestCase(TestCase):
         """
         self.assertEqual(self.make_private.__unicode__(), u"Make private")
 
+class GraphTestCase(TestCase):
+    """Tests the compiled workflow graph
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.user = User.objects.create()
+        self.page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+
+    def test_graph(self):
+        """
+        """
+        graph = workflows.graph.get_graph(self.w)
+        self.assertEqual(graph.initial_state, self.private)
+        self.assertEqual(graph.states, {self.private.id: self.private, self.public.id: self.public})
+        self.assertEqual(graph.get_transitions(self.private), (self.make_public, ))
+        self.assertEqual(graph.get_transitions(self.public), (self.make_private, ))
+        self.assertEqual(graph.get_transition("Make public"), self.make_public)
+        self.assertEqual(graph.get_transition("Wrong"), None)
+
+        # The graph is cached
+        with self.assertNumQueries(0):
+            self.assertTrue(workflows.graph.get_graph(self.w) is graph)
+            self.private.get_allowed_transitions(self.page_1, self.user)
+
+    def test_invalidation(self):
+        """
+        """
+        graph = workflows.graph.get_graph(self.w)
+
+        publish = Transition.objects.create(name="Publish", workflow=self.w, destination=self.public)
+        self.assertFalse(workflows.graph.get_graph(self.w) is graph)
+
+        graph = workflows.graph.get_graph(self.w)
+        self.private.transitions.add(publish)
+        graph = workflows.graph.get_graph(self.w)
+        self.assertEqual(graph.get_transitions(self.private), (self.make_public, publish))
+
+        view = permissions.utils.register_permission("View", "view")
+        owner = permissions.utils.register_role("Owner")
+        StatePermissionRelation.objects.create(state=self.public, permission=view, role=owner)
+        StateInheritanceBlock.objects.create(state=self.public, permission=view)
+        WorkflowPermissionRelation.objects.create(workflow=self.w, permission=view)
+
+        graph = workflows.graph.get_graph(self.w)
+        self.assertEqual(graph.get_grants(self.public), frozenset([(owner, view)]))
+        self.assertEqual(graph.get_blocks(self.public), frozenset([view]))
+        self.assertEqual(graph.get_grants(self.private), frozenset())
+        self.assertEqual(graph.permissions, frozenset([view]))
+
+class GraphAnalyticsTestCase(TestCase):
+    """Tests the graph algorithms and do_transition_path
+    """
+    def setUp(self):
+        """
+        """
+        self.w = Workflow.objects.create(name="Publishing")
+        self.draft = State.objects.create(name="Draft", workflow=self.w)
+        self.review = State.objects.create(name="Review", workflow=self.w)
+        self.approved = State.objects.create(name="Approved", workflow=self.w)
+        self.published = State.objects.create(name="Published", workflow=self.w)
+        self.archived = State.objects.create(name="Archived", workflow=self.w)
+        self.w.initial_state = self.draft
+        self.w.save()
+
+        self.approve_permission = Permission.objects.create(name="Approve", codename="approve")
+        self.reviewer = permissions.utils.register_role("Reviewer")
+        WorkflowPermissionRelation.objects.create(workflow=self.w, permission=self.approve_permission)
+        StatePermissionRelation.objects.create(
+            state=self.review, permission=self.approve_permission, role=self.reviewer)
+
+        self.submit = self.add_transition("Submit", self.draft, self.review)
+        self.approve = self.add_transition("Approve", self.review, self.approved, self.approve_permission)
+        self.publish = self.add_transition("Publish", self.approved, self.published)
+        self.reject = self.add_transition("Reject", self.review, self.draft)
+        self.publish_now = self.add_transition("Publish now", self.draft, self.published, self.approve_permission)
+        self.unarchive = self.add_transition("Unarchive", self.archived, self.draft)
+
+        self.user = User.objects.create(username="john")
+        self.page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        workflows.utils.set_workflow_for_object(self.page_1, self.w)
+
+    def add_transition(self, name, source, destination, permission=None):
+        transition = Transition.objects.create(
+            name=name, workflow=self.w, destination=destination, permission=permission)
+        source.transitions.add(transition)
+        return transition
+
+    def test_analytics(self):
+        """
+        """
+        graph = workflows.graph.get_graph(self.w)
+        self.assertEqual(graph.get_reachable_states(),
+                         frozenset([self.draft, self.review, self.approved, self.published]))
+        self.assertEqual(graph.get_reachable_states(self.approved), frozenset([self.approved, self.published]))
+        self.assertEqual(graph.get_unreachable_states(), frozenset([self.archived]))
+        self.assertEqual(graph.get_sink_states(), frozenset([self.published]))
+
+        self.assertEqual(graph.get_path(self.draft, self.published), [self.publish_now])
+        self.assertEqual(graph.get_path(self.review, self.draft), [self.reject])
+        self.assertEqual(graph.get_path(self.draft, self.draft), [])
+        self.assertEqual(graph.get_path(self.published, self.draft), None)
+        self.assertEqual(graph.get_path(self.draft, self.published, lambda s, t: t != self.publish_now),
+                         [self.submit, self.approve, self.publish])
+
+    def test_do_transition_path(self):
+        """
+        """
+        # Approve is only granted within Review, Publish now not at all
+        permissions.utils.add_role(self.user, self.reviewer)
+        self.assertEqual(workflows.utils.do_transition_path(self.page_1, self.published, self.user), True)
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.published)
+        # with a single state change
+        self.assertEqual(workflows.utils.get_state_version(self.page_1), 1)
+
+        logs = StateTransitionLog.objects.filter(transition__isnull=False).order_by("id")
+        self.assertEqual([log.transition for log in logs], [self.submit, self.approve, self.publish])
+        self.assertEqual([log.to_state for log in logs], [self.review, self.approved, self.published])
+
+        # The permissions are those of the target state
+        self.assertEqual(ObjectPermission.objects.filter(content_id=self.page_1.id).count(), 0)
+
+        # No path back
+        self.assertEqual(workflows.utils.do_transition_path(self.page_1, "Draft", self.user), False)
+
+    def test_do_transition_path_not_allowed(self):
+        """
+        """
+        self.assertEqual(workflows.utils.do_transition_path(self.page_1, self.published, self.user), False)
+        self.assertEqual(workflows.utils.do_transition_path(self.page_1, "Review", self.user), True)
+        self.assertEqual(workflows.utils.get_state(self.page_1), self.review)
+        self.assertEqual(ObjectPermission.objects.filter(
+            content_id=self.page_1.id, permission=self.approve_permission).count(), 1)
+
+class StateCountTestCase(TestCase):
+    """Tests the maintained amounts of objects per state
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.user = User.objects.create(username="john", is_superuser=True)
+        self.page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        self.page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        self.ctype = ContentType.objects.get_for_model(self.page_1)
+
+    def assertCounts(self, private, public):
+        self.assertEqual(workflows.utils.get_state_counts(self.w), {self.private: private, self.public: public})
+
+        # The counters match the objects
+        counts = dict(((c.state_id, c.content_type_id), c.count) for c in StateObjectCount.objects.all())
+        workflows.utils.rebuild_state_counts()
+        self.assertEqual(dict(((c.state_id, c.content_type_id), c.count) for c in StateObjectCount.objects.all()),
+                         dict((key, count) for key, count in counts.items() if count))
+
+    def test_counts(self):
+        """
+        """
+        self.assertCounts(0, 0)
+
+        workflows.utils.set_workflow_for_object(self.page_1, self.w)
+        self.assertCounts(1, 0)
+
+        workflows.utils.do_transition(self.page_1, self.make_public, self.user)
+        self.assertCounts(0, 1)
+
+        workflows.utils.set_state(self.page_1, self.public)
+        self.assertCounts(0, 1)
+
+        workflows.utils.set_workflow_for_model(self.ctype, self.w)
+        workflows.utils.set_state_many(FlatPage.objects.all(), self.private)
+        self.assertCounts(2, 0)
+
+        workflows.utils.do_transition_path(self.page_2, self.public, self.user)
+        self.assertCounts(1, 1)
+
+        workflows.utils.remove_workflow_from_model(self.ctype)
+        self.assertCounts(1, 0)
+
+    def test_existing_objects(self):
+        """Counters are seeded for objects which are there already.
+        """
+        page_3 = FlatPage.objects.create(url="/page-3/", title="Page 3")
+        workflows.utils.set_state_many([self.page_1, self.page_2, page_3], self.private)
+
+        # As before the counters have been introduced
+        StateObjectCount.objects.all().delete()
+        workflows.utils.set_state(self.page_1, self.public)
+        workflows.utils.set_state(self.page_1, self.private)
+        self.assertEqual(workflows.utils.get_state_counts(self.w), {self.private: 3, self.public: 0})
+
+        # The migration fills the counters
+        StateObjectCount.objects.all().delete()
+        migration = importlib.import_module("workflows.migrations.0007_stateobjectcount")
+        migration.fill_counts(apps, None)
+        self.assertEqual(workflows.utils.get_state_counts(self.w), {self.private: 3, self.public: 0})
+
+    def test_migrate_workflow(self):
+        """
+        """
+        workflows.utils.set_workflow_for_object(self.page_1, self.w)
+        workflow = Workflow.objects.create(name="Other")
+        draft = State.objects.create(name="Draft", workflow=workflow)
+
+        workflows.utils.migrate_workflow(self.w, workflow, {"Private": draft, "Public": draft})
+        self.assertCounts(0, 0)
+        self.assertEqual(workflows.utils.get_state_counts(workflow), {draft: 1})
+
+    def test_rebuild(self):
+        """
+        """
+        workflows.utils.set_workflow_for_object(self.page_1, self.w)
+        StateObjectRelation.objects.filter(content_id=self.page_1.id).update(state=self.public)
+        self.assertEqual(workflows.utils.get_state_counts(self.w), {self.private: 1, self.public: 0})
+
+        out = StringIO()
+        call_command("rebuild_state_counts", workflow="Standard", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Rebuilt 1 counters.")
+        self.assertEqual(workflows.utils.get_state_counts(self.w), {self.private: 0, self.public: 1})
+
+        with self.assertRaises(CommandError):
+            call_command("rebuild_state_counts", workflow="Wrong", stdout=out)
+
+class SnapshotTestCase(TestCase):
+    """Tests the serialized workflow snapshots
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.generation = WorkflowSnapshot.objects.get(workflow=self.w).generation
+        self.reset()
+
+    def tearDown(self):
+        """
+        """
+        self.reset()
+
+    def reset(self):
+        workflows.graph.invalidate()
+        workflows.graph._check_state.update(file_loaded=False, checked_at=None)
+
+    def test_snapshot(self):
+        """
+        """
+        with self.settings(WORKFLOWS_SNAPSHOTS=True):
+            graph = workflows.graph.get_graph(self.w)
+            snapshot = WorkflowSnapshot.objects.get(workflow=self.w)
+            self.assertEqual(snapshot.generation, self.generation)
+            self.assertEqual(json.loads(snapshot.data), workflows.graph.get_definition(self.w))
+
+            # Another process loads the graph with a single query
+            self.reset()
+            with self.assertNumQueries(1):
+                loaded = workflows.graph.get_graph(self.w.id)
+            self.assertFalse(loaded is graph)
+            self.assertEqual(loaded.initial_state, self.private)
+            self.assertEqual(loaded.get_transitions(self.private), (self.make_public, ))
+            self.assertEqual(loaded.get_transitions(self.public), (self.make_private, ))
+
+    def test_generation(self):
+        """
+        """
+        with self.settings(WORKFLOWS_SNAPSHOTS=True, WORKFLOWS_GRAPH_CHECK_INTERVAL=0):
+            graph = workflows.graph.get_graph(self.w)
+
+            publish = Transition.objects.create(name="Publish", workflow=self.w, destination=self.public)
+            self.private.transitions.add(publish)
+            snapshot = WorkflowSnapshot.objects.get(workflow=self.w)
+            self.assertEqual(snapshot.generation, self.generation + 2)
+            self.assertEqual(snapshot.data, "")
+
+            graph = workflows.graph.get_graph(self.w)
+            self.assertEqual(graph.get_transitions(self.private), (self.make_public, publish))
+
+            # A change by another process is detected by the generation check
+            State.transitions.through.objects.filter(transition=publish).delete()
+            WorkflowSnapshot.objects.filter(workflow=self.w).update(generation=self.generation + 3, data="")
+            self.assertTrue(workflows.graph.get_graph(self.w) is not graph)
+            graph = workflows.graph.get_graph(self.w)
+            self.assertEqual(graph.get_transitions(self.private), (self.make_public, ))
+
+            # Unchanged graphs are kept
+            with self.assertNumQueries(1):
+                self.assertTrue(workflows.graph.get_graph(self.w) is graph)
+
+    def test_generation_without_snapshots(self):
+        """
+        """
+        snapshot = WorkflowSnapshot.objects.get(workflow=self.w)
+        self.assertEqual(snapshot.data, "")
+
+        # Reading a graph doesn't write, a missing snapshot is generation 0
+        snapshot.delete()
+        with CaptureQueriesContext(connection) as queries:
+            graph = workflows.graph.get_graph(self.w)
+        self.assertFalse([q for q in queries.captured_queries if "SELECT" not in q["sql"]])
+        self.assertFalse(WorkflowSnapshot.objects.exists())
+
+        # The generations are checked once per interval
+        with self.assertNumQueries(0):
+            self.assertTrue(workflows.graph.get_graph(self.w) is graph)
+
+        # A change by another process is detected by the generation check
+        State.transitions.through.objects.filter(transition=self.make_public).delete()
+        WorkflowSnapshot.objects.create(workflow=self.w, generation=1)
+        with self.settings(WORKFLOWS_GRAPH_CHECK_INTERVAL=0):
+            graph = workflows.graph.get_graph(self.w)
+            self.assertEqual(graph.get_transitions(self.private), ())
+
+            with self.assertNumQueries(1):
+                self.assertTrue(workflows.graph.get_graph(self.w) is graph)
+
+    def test_file(self):
+        """
+        """
+        handle, path = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        try:
+            with self.settings(WORKFLOWS_SNAPSHOTS=True):
+                out = StringIO()
+                call_command("dump_workflow_snapshots", path, stdout=out)
+                self.assertIn(path, out.getvalue())
+
+            # The graphs are loaded from the file without any query
+            self.reset()
+            with self.settings(WORKFLOWS_SNAPSHOTS=True, WORKFLOWS_SNAPSHOT_FILE=path):
+                with self.assertNumQueries(0):
+                    graph = workflows.graph.get_graph(self.w.id)
+                self.assertEqual(graph.initial_state, self.private)
+                self.assertEqual(graph.get_transition("Make public"), self.make_public)
+        finally:
+            os.remove(path)
+
+class CacheTestCase(TransactionTestCase):
+    """Tests the shared cache of workflows and states (outside of a test
+    transaction, as the cache is only written after commit).
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.user = User.objects.create(username="john", is_superuser=True)
+        self.page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        self.page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        self.ctype = ContentType.objects.get_for_model(self.page_1)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        """
+        shutil.rmtree(self.cache_dir)
+        # The ids are reused after the tables have been flushed
+        workflows.graph.invalidate()
+        ContentType.objects.clear_cache()
+
+    def get_settings(self):
+        """Returns the settings for all tested cache backends.
+        """
+        return [
+            {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "workflows-tests"},
+            {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": self.cache_dir},
+        ]
+
+    def test_write_through(self):
+        """
+        """
+        for backend in self.get_settings():
+            with self.settings(CACHES={"default": backend}, WORKFLOWS_CACHE="default"):
+                workflows.utils.set_workflow_for_object(self.page_1, self.w)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_workflow_for_object(self.page_1), self.w)
+                    self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+
+                workflows.utils.do_transition(self.page_1, self.make_public, self.user)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_state(self.page_1), self.public)
+
+                workflows.utils.set_state(self.page_1, self.private)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+
+                workflows.utils.remove_workflow_from_object(self.page_1)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_workflow_for_object(self.page_1), None)
+
+                workflows.utils.set_workflow_for_model(self.ctype, self.w)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_workflow_for_model(self.ctype), self.w)
+
+                # Cache misses are filled
+                with self.assertNumQueries(2):
+                    self.assertEqual(workflows.utils.get_workflow(self.page_2), self.w)
+                    self.assertEqual(workflows.utils.get_state(self.page_2), None)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_workflow(self.page_2), self.w)
+                    self.assertEqual(workflows.utils.get_state(self.page_2), None)
+
+                workflows.utils.set_state_many([self.page_1, self.page_2], self.public)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_state(self.page_1), self.public)
+                    self.assertEqual(workflows.utils.get_state(self.page_2), self.public)
+
+                workflows.utils.remove_workflow_from_model(self.ctype)
+                workflows.utils.remove_workflow_from_object(self.page_1)
+
+    def test_invalidate(self):
+        """
+        """
+        for backend in self.get_settings():
+            with self.settings(CACHES={"default": backend}, WORKFLOWS_CACHE="default"):
+                workflows.utils.set_workflow_for_model(self.ctype, self.w)
+                workflows.utils.set_state(self.page_1, self.private)
+                with self.assertNumQueries(0):
+                    workflows.utils.get_state(self.page_1)
+
+                # Bulk changes drop all cached values
+                workflows.utils.remove_workflow_from_model(self.ctype)
+                with self.assertNumQueries(3):
+                    self.assertEqual(workflows.utils.get_workflow(self.page_1), None)
+                    self.assertEqual(workflows.utils.get_state(self.page_1), None)
+
+                # as well as changes of workflows and states
+                workflows.utils.set_state(self.page_1, self.private)
+                self.private.name = "Draft"
+                self.private.save()
+                self.assertEqual(workflows.utils.get_state(self.page_1).name, "Draft")
+
+                StateObjectRelation.objects.all().delete()
+                workflows.cache.invalidate()
+
+    def test_transaction(self):
+        """
+        """
+        for backend in self.get_settings():
+            with self.settings(CACHES={"default": backend}, WORKFLOWS_CACHE="default"):
+                workflows.utils.set_workflow_for_object(self.page_1, self.w)
+
+                # Changes within a transaction drop the cached value at once,
+                # reads don't fill the cache with uncommitted values
+                page = FlatPage.objects.get(pk=self.page_1.pk)
+                with transaction.atomic():
+                    workflows.utils.set_state(self.page_1, self.public)
+                    for i in range(2):
+                        with self.assertNumQueries(1):
+                            self.assertEqual(workflows.utils.get_state(page), self.public)
+
+                # Without on_commit the value is left to the next read
+                if not hasattr(transaction, "on_commit"):
+                    with self.assertNumQueries(1):
+                        self.assertEqual(workflows.utils.get_state(page), self.public)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_state(page), self.public)
+
+                # A batch writes the values after commit
+                with workflows.utils.batch():
+                    workflows.utils.set_state(self.page_1, self.private)
+                with self.assertNumQueries(0):
+                    self.assertEqual(workflows.utils.get_state(page), self.private)
+
+                workflows.utils.remove_workflow_from_object(self.page_1)
+                StateObjectRelation.objects.all().delete()
+                workflows.cache.invalidate()
+
+    def test_rollback(self):
+        """
+        """
+        for backend in self.get_settings():
+            with self.settings(CACHES={"default": backend}, WORKFLOWS_CACHE="default"):
+                workflows.utils.set_workflow_for_object(self.page_1, self.w)
+                self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+
+                for atomic in (transaction.atomic, workflows.utils.batch):
+                    try:
+                        with atomic():
+                            page = FlatPage.objects.get(pk=self.page_1.pk)
+                            self.assertTrue(workflows.utils.do_transition(page, self.make_public, self.user))
+                            raise ValueError()
+                    except ValueError:
+                        pass
+
+                    page = FlatPage.objects.get(pk=self.page_1.pk)
+                    self.assertEqual(workflows.utils.get_state(page), self.private)
+
+                page = FlatPage.objects.get(pk=self.page_1.pk)
+                self.assertTrue(workflows.utils.do_transition(page, self.make_public, self.user))
+
+                workflows.utils.remove_workflow_from_object(self.page_1)
+                StateObjectRelation.objects.all().delete()
+                workflows.cache.invalidate()
+
+    def test_outdated(self):
+        """
+        """
+        for backend in self.get_settings():
+            with self.settings(CACHES={"default": backend}, WORKFLOWS_CACHE="default"):
+                workflows.utils.set_workflow_for_object(self.page_1, self.w)
+
+                # An outdated state has been cached by another process
+                workflows.cache.fill_state(self.ctype, self.page_1.id, self.public)
+                page = FlatPage.objects.get(pk=self.page_1.pk)
+                self.assertEqual(workflows.utils.get_state(page), self.public)
+
+                # The failed transition drops it
+                self.assertFalse(workflows.utils.do_transition(page, self.make_private, self.user))
+                page = FlatPage.objects.get(pk=self.page_1.pk)
+                self.assertEqual(workflows.utils.get_state(page), self.private)
+                self.assertTrue(workflows.utils.do_transition(page, self.make_public, self.user))
+
+                workflows.utils.remove_workflow_from_object(self.page_1)
+                StateObjectRelation.objects.all().delete()
+                workflows.cache.invalidate()
+
+    def test_disabled(self):
+        """
+        """
+        workflows.utils.set_state(self.page_1, self.private)
+        with self.assertNumQueries(1):
+            self.assertEqual(workflows.utils.get_state(self.page_1), self.private)
+
+class WorkflowPage(FlatPage, WorkflowBase):
+    """A workflow aware flat page for the tests of WorkflowBase.
+    """
+    class Meta:
+        proxy = True
+        app_label = "workflows"
+
+
+class WorkflowBaseTestCase(TestCase):
+    """Tests the memoization of the WorkflowBase mixin
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.user = User.objects.create(username="john", is_superuser=True)
+        self.page_1 = WorkflowPage.objects.create(url="/page-1/", title="Page 1")
+
+    def test_memoization(self):
+        """
+        """
+        self.page_1.set_workflow(self.w)
+        page = WorkflowPage.objects.get(pk=self.page_1.pk)
+
+        with self.assertNumQueries(2):
+            for i in range(5):
+                self.assertEqual(page.get_workflow(), self.w)
+                self.assertEqual(page.get_state(), self.private)
+
+        page.do_transition(self.make_public, self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(page.get_state(), self.public)
+
+        page.set_state(self.private)
+        with self.assertNumQueries(0):
+            self.assertEqual(page.get_state(), self.private)
+
+        page.set_initial_state()
+        with self.assertNumQueries(0):
+            self.assertEqual(page.get_state(), self.private)
+
+        page.remove_workflow()
+        self.assertEqual(page.get_workflow(), None)
+        self.assertEqual(page.get_state(), self.private)
+        with self.assertNumQueries(0):
+            self.assertEqual(page.get_workflow(), None)
+
+        workflow = Workflow.objects.create(name="Other")
+        draft = State.objects.create(name="Draft", workflow=workflow)
+        workflow.initial_state = draft
+        workflow.save()
+
+        page.set_workflow(workflow)
+        with self.assertNumQueries(0):
+            self.assertEqual(page.get_workflow(), workflow)
+            self.assertEqual(page.get_state(), draft)
+
+    def test_refresh(self):
+        """
+        """
+        self.assertEqual(self.page_1.get_workflow(), None)
+
+        ctype = ContentType.objects.get_for_model(self.page_1)
+        workflows.utils.set_workflow_for_model(ctype, self.w)
+        self.assertEqual(self.page_1.get_workflow(), None)
+
+        self.page_1.refresh_workflow_state()
+        self.assertEqual(self.page_1.get_workflow(), self.w)
+
+    def test_outdated(self):
+        """
+        """
+        self.page_1.set_workflow(self.w)
+        page = WorkflowPage.objects.get(pk=self.page_1.pk)
+        self.assertEqual(page.get_state(), self.private)
+
+        # Changed by another instance meanwhile
+        WorkflowPage.objects.get(pk=self.page_1.pk).do_transition(self.make_public, self.user)
+
+        # The failed transition drops the outdated state
+        self.assertFalse(page.do_transition(self.make_public, self.user))
+        self.assertEqual(page.get_state(), self.public)
+        self.assertTrue(page.do_transition(self.make_private, self.user))
+        self.assertEqual(page.get_state(), self.private)
+
+class ConditionsTestCase(TestCase):
+    """Tests the conditions of transitions.
+    """
+    def setUp(self):
+        """
+        """
+        create_workflow(self)
+        self.user = User.objects.create(username="john", is_superuser=True)
+        self.page_1 = FlatPage.objects.create(url="/page-1/", title="Page 1")
+        workflows.utils.set_workflow(self.page_1, self.w)
+
+    def test_compile_condition(self):
+        """
+        """
+        workflows.conditions.compile_condition("obj.title != '' and user.is_superuser or state.name in ['Draft']")
+
+        for condition in ("obj.delete()", "obj._meta", "obj.title[0]", "__import__('os')", "lambda: 1", "obj.title ="):
+            self.assertRaises(workflows.conditions.ConditionError, workflows.conditions.compile_condition, condition)
+
+    def test_clean(self):
+        """
+        """
+        self.make_public.condition = "obj.save()"
+        self.assertRaises(ValidationError, self.make_public.clean)
+
+        self.make_public.condition = "obj.title == 'Page 1'"
+        self.make_public.clean()
+
+    def test_get_allowed_transitions(self):
+        """
+        """
+        self.make_public.condition = "obj.title == 'Page 2'"
+        self.make_public.save()
+
+        result = workflows.utils.get_allowed_transitions(self.page_1, self.user)
+        self.assertEqual(result, [])
+
+        # The cached condition is invalidated on save
+        self.make_public.condition = "obj.title == 'Page 1' and state.name == 'Private'"
+        self.make_public.save()
+
+        result = workflows.utils.get_allowed_transitions(self.page_1, self.user)
+        self.assertEqual(result, [self.make_public])
+
+        # Invalid or failing conditions are not fulfilled, but logged
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger("workflows.conditions")
+        logger.addHandler(handler)
+        try:
+            for condition in ("obj.title(", "obj.missing == 1", "1 / 0"):
+                Transition.objects.filter(pk=self.make_public.pk).update(condition=condition)
+                workflows.graph.invalidate()
+                result = workflows.utils.get_allowed_transitions(self.page_1, self.user)
+                self.assertEqual(result, [])
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual([record.levelname for record in records], ["WARNING"] * 3)
+        self.assertIn("Invalid condition", records[0].getMessage())
+        self.assertEqual([record.exc_info[0] for record in records[1:]], [AttributeError, ZeroDivisionError])
+
+    def test_check_conditions(self):
+        """
+        """
+        Transition.objects.filter(pk=self.make_public.pk).update(condition="obj.save()")
+        self.make_private.condition = "obj.title != ''"
+        self.make_private.save()
+
+        result = workflows.conditions.check_conditions()
+        self.assertEqual([transition for transition, error in result], [self.make_public])
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command("check_workflow_conditions", stdout=out)
+        self.assertIn("Standard: Make public: Call is not allowed within conditions.", out.getvalue())
+
+        Transition.objects.filter(pk=self.make_public.pk).update(condition="")
+        call_command("check_workflow_conditions", workflow="Standard", stdout=out)
+        self.assertIn("All conditions are valid.", out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command("check_workflow_conditions", workflow="Wrong", stdout=out)
+
+    def test_compile_q(self):
+        """
+        """
+        page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2", registration_required=True)
+        page_3 = FlatPage.objects.create(url="/page-3/", title="", registration_required=True)
+
+        def filter(condition, user=None):
+            q = workflows.conditions.compile_q(condition, user, FlatPage)
+            return sorted(FlatPage.objects.filter(q).values_list("url", flat=True))
+
+        self.assertEqual(filter("obj.title != '' and obj.registration_required"), ["/page-2/"])
+        self.assertEqual(filter("not obj.registration_required or obj.title == ''"), ["/page-1/", "/page-3/"])
+        self.assertEqual(filter("obj.url in ['/page-1/', '/page-3/'] and obj.title is not None"), ["/page-1/", "/page-3/"])
+        self.assertEqual(filter("'/page-2/' <= obj.url"), ["/page-2/", "/page-3/"])
+        self.assertEqual(filter("obj.title == obj.url"), [])
+        self.assertEqual(filter("user.is_superuser and obj.title == 'Page 1'", self.user), ["/page-1/"])
+        self.assertEqual(filter("not user.is_superuser", self.user), [])
+        self.assertEqual(filter("obj.title == 'x' or user.is_superuser", self.user), ["/page-1/", "/page-2/", "/page-3/"])
+
+        for condition in ("state.name == 'Private'", "obj.title + 'x' == 'y'", "'P' in obj.title", "obj.title == user.x",
+                          "obj.title", "not obj.title", "obj.missing"):
+            self.assertRaises(workflows.conditions.ConditionError, workflows.conditions.compile_q, condition, self.user, FlatPage)
+
+        # Fields on their own can't be checked without the model
+        self.assertRaises(workflows.conditions.ConditionError, workflows.conditions.compile_q, "obj.registration_required")
+
+    def test_filter_transitionable(self):
+        """
+        """
+        page_2 = FlatPage.objects.create(url="/page-2/", title="Page 2")
+        page_3 = FlatPage.objects.create(url="/page-3/", title="")
+        workflows.utils.set_workflow(page_2, self.w)
+        workflows.utils.set_workflow(page_3, self.w)
+        workflows.utils.set_state(page_2, self.public)
+
+        self.make_public.condition = "obj.title != ''"
+        self.make_public.save()
+
+        result = workflows.utils.filter_transitionable(FlatPage.objects.all(), self.make_public)
+        self.assertEqual(list(result), [self.page_1])
+
+        result = workflows.utils.filter_transitionable(FlatPage.objects.all(), self.make_private)
+        self.assertEqual(list(result), [page_2])
+
+        # Only boolean fields can be checked on their own
+        self.make_public.condition = "obj.title"
+        self.make_public.save()
+        self.assertRaises(workflows.conditions.ConditionError, workflows.utils.filter_transitionable,
+                          FlatPage.objects.all(), self.make_public)
+
+        self.make_public.condition = "obj.registration_required"
+        self.make_public.save()
+        result = workflows.utils.filter_transitionable(FlatPage.objects.all(), self.make_public)
+        self.assertEqual(list(result), [])
+
 class RelationsTestCase(TestCase):
     """Tests various Relations models.
     """
@@ -531,6 +2012,15 @@ class RelationsTestCase(TestCase):
         spr = StatePermissionRelation.objects.create(state=self.public, permission=self.view, role=self.owner)
         self.assertEqual(spr.__unicode__(), "Public Owner View")
 
+    def test_unique_state(self):
+        """An object has one state at most.
+        """
+        workflows.utils.set_state(self.page_1, self.public)
+        ctype = ContentType.objects.get_for_model(self.page_1)
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, StateObjectRelation.objects.create,
+                content_type=ctype, content_id=self.page_1.id, state=self.private)
+
 # Helpers ####################################################################
 
 def create_workflow(self):
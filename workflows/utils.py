@@ -1,23 +1,46 @@
+# python imports
+import contextlib
+import multiprocessing
+import threading
+from datetime import timedelta
+
 # django imports
+import django
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db import connections
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Sum
+from django.utils import timezone
 
 # workflows imports
 from permissions.models import ObjectPermission
 from permissions.models import ObjectPermissionInheritanceBlock
-from workflows.models import StateInheritanceBlock
+import workflows.cache
+import workflows.conditions
+import workflows.propagation
+from workflows.graph import get_graph
+from workflows.metrics import instrument
+from workflows.models import ScheduledTransition
+from workflows.models import State
+from workflows.models import StateObjectCount
 from workflows.models import StateObjectRelation
-from workflows.models import StatePermissionRelation
+from workflows.models import StateTransitionLog
 from workflows.models import Transition
 from workflows.models import Workflow
 from workflows.models import WorkflowModelRelation
 from workflows.models import WorkflowObjectRelation
-from workflows.models import WorkflowPermissionRelation
 
 # permissions imports
 import permissions.utils
+from permissions import PermissionBase
 
 
-def get_objects_for_workflow(workflow):
+def get_objects_for_workflow(workflow, as_queryset=False):
     """Returns all objects which have passed workflow.
 
     **Parameters:**
@@ -25,6 +48,10 @@ def get_objects_for_workflow(workflow):
     workflow
         The workflow for which the objects are returned. Can be a Workflow
         instance or a string with the workflow name.
+
+    as_queryset
+        If True a list with one lazy queryset per content type is returned
+        instead of the objects itself.
     """
     if not isinstance(workflow, Workflow):
         try:
@@ -32,9 +59,12 @@ def get_objects_for_workflow(workflow):
         except Workflow.DoesNotExist:
             return []
 
+    if as_queryset:
+        return workflow.get_querysets()
     return workflow.get_objects()
 
 
+@instrument("remove_workflow")
 def remove_workflow(ctype_or_obj):
     """Removes the workflow from the passed content type or object. After this
     function has been called the content type or object has no workflow
@@ -58,42 +88,44 @@ def remove_workflow(ctype_or_obj):
         remove_workflow_from_object(ctype_or_obj)
 
 
-def remove_workflow_from_model(ctype):
+@instrument("remove_workflow_from_model")
+def remove_workflow_from_model(ctype, chunk_size=None):
     """Removes the workflow from passed content type. After this function has
     been called the content type has no workflow anymore (the instances might
     have own ones).
 
+    The states, permissions and inheritance blocks of all instances without an
+    own workflow are deleted in chunks, without loading the instances.
+
     ctype
         The content type from which the passed workflow should be removed.
         Must be a ContentType instance.
-    """
-    # First delete all states, inheritance blocks and permissions from ctype's
-    # instances which have passed workflow.
-    workflow = get_workflow_for_model(ctype)
-    for obj in get_objects_for_workflow(workflow):
-        # Only take care of the given ctype.
-        obj_ctype = ContentType.objects.get_for_model(obj)
-        if ctype != obj_ctype:
-            continue
-        try:
-            ctype = ContentType.objects.get_for_model(obj)
-            sor = StateObjectRelation.objects.get(content_id=obj.id, content_type=ctype)
-        except StateObjectRelation.DoesNotExist:
-            pass
-        else:
-            sor.delete()
-
-        # Reset all permissions
-        permissions.utils.reset(obj)
 
+    chunk_size
+        The amount of rows which are deleted at once. Defaults to the
+        ``WORKFLOWS_CHUNK_SIZE`` setting or 500.
+    """
     try:
         wmr = WorkflowModelRelation.objects.get(content_type=ctype)
     except WorkflowModelRelation.DoesNotExist:
-        pass
-    else:
-        wmr.delete()
+        return
+
+    # Instances with an own workflow are not affected.
+    own_workflow = WorkflowObjectRelation.objects.filter(
+        content_type=ctype, content_id__isnull=False).values("content_id")
 
+    chunk_size = chunk_size or _get_chunk_size()
+    _delete_states_in_chunks(StateObjectRelation.objects.filter(content_type=ctype).exclude(
+        content_id__in=own_workflow), chunk_size)
+    for model in (ObjectPermission, ObjectPermissionInheritanceBlock):
+        _delete_in_chunks(model.objects.filter(content_type=ctype).exclude(
+            content_id__in=own_workflow), chunk_size)
 
+    wmr.delete()
+    workflows.cache.invalidate()
+
+
+@instrument("remove_workflow_from_object")
 def remove_workflow_from_object(obj):
     """Removes the workflow from the passed object. After this function has
     been called the object has no *own* workflow anymore (it might have one
@@ -103,13 +135,17 @@ def remove_workflow_from_object(obj):
         The object from which the passed workflow should be set. Must be a
         Django Model instance.
     """
+    ctype = ContentType.objects.get_for_model(obj)
     try:
-        wor = WorkflowObjectRelation.objects.get(content_type=obj)
+        wor = WorkflowObjectRelation.objects.get(content_type=ctype, content_id=obj.id)
     except WorkflowObjectRelation.DoesNotExist:
         pass
     else:
         wor.delete()
 
+    workflows.cache.set_object_workflow(ctype, obj.id, None)
+    _clear_prefetched(obj)
+
     # Reset all permissions
     permissions.utils.reset(obj)
 
@@ -117,6 +153,7 @@ def remove_workflow_from_object(obj):
     set_initial_state(obj)
 
 
+@instrument("set_workflow")
 def set_workflow(ctype_or_obj, workflow):
     """Sets the workflow for passed content type or object. See the specific
     methods for more information.
@@ -134,6 +171,7 @@ def set_workflow(ctype_or_obj, workflow):
     return workflow.set_to(ctype_or_obj)
 
 
+@instrument("set_workflow_for_object")
 def set_workflow_for_object(obj, workflow):
     """Sets the passed workflow to the passed object.
 
@@ -159,6 +197,7 @@ def set_workflow_for_object(obj, workflow):
     workflow.set_to_object(obj)
 
 
+@instrument("set_workflow_for_model")
 def set_workflow_for_model(ctype, workflow):
     """Sets the passed workflow to the passed content type. If the content
     type has already an assigned workflow the workflow is overwritten.
@@ -195,6 +234,11 @@ def get_workflow(obj):
         The object for which the workflow should be returend. Can be any
         Django model instance.
     """
+    try:
+        return getattr(obj, _WORKFLOW_ATTR)
+    except AttributeError:
+        pass
+
     workflow = get_workflow_for_object(obj)
     if workflow is not None:
         return workflow
@@ -212,13 +256,21 @@ def get_workflow_for_object(obj):
         The object for which the workflow should be returned. Can be any
         Django model instance.
     """
+    ctype = ContentType.objects.get_for_model(obj)
+    workflow = workflows.cache.get_object_workflow(ctype, obj.id)
+    if workflow is not workflows.cache.MISSING:
+        return workflow
+
     try:
-        ctype = ContentType.objects.get_for_model(obj)
-        wor = WorkflowObjectRelation.objects.get(content_id=obj.id, content_type=ctype)
+        wor = WorkflowObjectRelation.objects.select_related("workflow").get(
+            content_id=obj.id, content_type=ctype)
     except WorkflowObjectRelation.DoesNotExist:
-        return None
+        workflow = None
     else:
-        return wor.workflow
+        workflow = wor.workflow
+
+    workflows.cache.fill_object_workflow(ctype, obj.id, workflow)
+    return workflow
 
 
 def get_workflow_for_model(ctype):
@@ -230,14 +282,22 @@ def get_workflow_for_model(ctype):
         The content type for which the workflow should be returned. Must be
         a Django ContentType instance.
     """
+    workflow = workflows.cache.get_model_workflow(ctype)
+    if workflow is not workflows.cache.MISSING:
+        return workflow
+
     try:
-        wor = WorkflowModelRelation.objects.get(content_type=ctype)
+        wor = WorkflowModelRelation.objects.select_related("workflow").get(content_type=ctype)
     except WorkflowModelRelation.DoesNotExist:
-        return None
+        workflow = None
     else:
-        return wor.workflow
+        workflow = wor.workflow
+
+    workflows.cache.fill_model_workflow(ctype, workflow)
+    return workflow
 
 
+@instrument("get_state")
 def get_state(obj):
     """Returns the current workflow state for the passed object.
 
@@ -247,15 +307,29 @@ def get_state(obj):
         The object for which the workflow state should be returned. Can be any
         Django model instance.
     """
+    try:
+        return getattr(obj, _STATE_ATTR)
+    except AttributeError:
+        pass
+
     ctype = ContentType.objects.get_for_model(obj)
+    state = workflows.cache.get_state(ctype, obj.id)
+    if state is not workflows.cache.MISSING:
+        return state
+
     try:
-        sor = StateObjectRelation.objects.get(content_type=ctype, content_id=obj.id)
+        sor = StateObjectRelation.objects.select_related("state").get(
+            content_type=ctype, content_id=obj.id)
     except StateObjectRelation.DoesNotExist:
-        return None
+        state = None
     else:
-        return sor.state
+        state = sor.state
 
+    workflows.cache.fill_state(ctype, obj.id, state)
+    return state
 
+
+@instrument("set_state")
 def set_state(obj, state):
     """Sets the state for the passed object to the passed state and updates
     the permissions for the object.
@@ -270,15 +344,122 @@ def set_state(obj, state):
         The state which should be set to the passed object.
     """
     ctype = ContentType.objects.get_for_model(obj)
-    try:
-        sor = StateObjectRelation.objects.get(content_type=ctype, content_id=obj.id)
-    except StateObjectRelation.DoesNotExist:
-        sor = StateObjectRelation.objects.create(content=obj, state=state)
-    else:
-        sor.state = state
-        sor.save()
+    with transaction.atomic():
+        try:
+            sor = StateObjectRelation.objects.get(content_type=ctype, content_id=obj.id)
+        except StateObjectRelation.DoesNotExist:
+            sor = StateObjectRelation.objects.create(content=obj, state=state)
+            from_state_id = None
+        else:
+            StateObjectRelation.objects.filter(pk=sor.pk).update(state=state, version=F("version") + 1)
+            from_state_id = sor.state_id
+        _change_state_counts(ctype, [(from_state_id, -1), (state, 1)])
+    workflows.cache.set_state(ctype, [obj.id], state)
+    _update_prefetched(obj, state=state)
     update_permissions(obj)
 
+    _log_state_changes([StateTransitionLog(
+        content_type=ctype, content_id=obj.id, from_state_id=from_state_id, to_state=state)])
+
+
+def get_state_version(obj):
+    """Returns the version of the current workflow state of the passed
+    object. The version is increased with every state change and can be
+    passed to ``do_transition`` in order to process a transition only if the
+    state hasn't been changed in the meanwhile.
+
+    **Parameters:**
+
+    obj
+        The object for which the version should be returned. Can be any
+        Django model instance.
+    """
+    ctype = ContentType.objects.get_for_model(obj)
+    try:
+        return StateObjectRelation.objects.filter(
+            content_type=ctype, content_id=obj.id).values_list("version", flat=True)[0]
+    except IndexError:
+        return None
+
+
+def prefetch_workflow_states(objs):
+    """Loads the workflows and workflow states of all passed objects at once
+    and attaches them to the objects. Afterwards ``get_workflow`` and
+    ``get_state`` don't hit the database anymore for these objects.
+
+    This needs one query for all model workflows and two queries per content
+    type of the passed objects (local workflows and states).
+
+    **Parameters:**
+
+    objs
+        The objects for which the workflows and states should be loaded. Can
+        be a list of any Django model instances (also of different content
+        types).
+    """
+    objs_by_ctype = {}
+    for obj in objs:
+        ctype = ContentType.objects.get_for_model(obj)
+        objs_by_ctype.setdefault(ctype, []).append(obj)
+
+    if not objs_by_ctype:
+        return
+
+    model_workflows = dict(
+        (wmr.content_type_id, wmr.workflow) for wmr in
+        WorkflowModelRelation.objects.filter(
+            content_type__in=list(objs_by_ctype.keys())).select_related("workflow"))
+
+    for ctype, ctype_objs in objs_by_ctype.items():
+        ids = [obj.pk for obj in ctype_objs]
+
+        object_workflows = dict(
+            (wor.content_id, wor.workflow) for wor in
+            WorkflowObjectRelation.objects.filter(
+                content_type=ctype, content_id__in=ids).select_related("workflow"))
+
+        states = dict(
+            (sor.content_id, sor.state) for sor in
+            StateObjectRelation.objects.filter(
+                content_type=ctype, content_id__in=ids).select_related("state"))
+
+        for obj in ctype_objs:
+            setattr(obj, _WORKFLOW_ATTR, object_workflows.get(obj.pk, model_workflows.get(ctype.id)))
+            setattr(obj, _STATE_ATTR, states.get(obj.pk))
+
+
+@instrument("set_state_many")
+def set_state_many(objs, state, chunk_size=None):
+    """Sets the passed state to all passed objects and updates the permissions
+    of the objects. This is the bulk version of ``set_state``: the objects are
+    processed in chunks with a fixed number of queries per chunk.
+
+    **Parameters:**
+
+    objs
+        The objects for which the workflow state should be set. Can be a
+        queryset or any iterable of Django model instances (also of different
+        content types).
+
+    state
+        The state which should be set to the passed objects.
+
+    chunk_size
+        The amount of objects which are processed at once. Defaults to the
+        ``WORKFLOWS_CHUNK_SIZE`` setting or 500.
+    """
+    if not hasattr(objs, "values_list"):
+        objs = list(objs)
+
+    chunk_size = chunk_size or _get_chunk_size()
+    for ctype, ids in _group_ids_by_content_type(objs).items():
+        for i in range(0, len(ids), chunk_size):
+            _set_state_for_ids(ctype, ids[i:i + chunk_size], state)
+
+    if isinstance(objs, list):
+        for obj in objs:
+            _update_prefetched(obj, state=state)
+
 
 def set_initial_state(obj):
     """Sets the initial state to the passed object.
@@ -307,24 +488,223 @@ def get_allowed_transitions(obj, user):
     return state.get_allowed_transitions(obj, user)
 
 
-def do_transition(obj, transition, user):
+def filter_transitionable(queryset, transition, user=None):
+    """Returns a new queryset which contains only the objects of the passed
+    queryset which can take the passed transition: objects which are in a
+    state with this transition and which fulfill its condition. Both is
+    checked within the database.
+
+    The condition must be translatable into a Q object (see
+    ``workflows.conditions.compile_q``), otherwise ConditionError is raised.
+    Permissions are not taken into account.
+
+    **Parameters:**
+
+    queryset
+        The queryset which is filtered.
+
+    transition
+        The transition the objects should be able to take. Must be a
+        Transition instance.
+
+    user
+        The user for whom the condition is checked.
+    """
+    ctype = ContentType.objects.get_for_model(queryset.model)
+    sors = StateObjectRelation.objects.filter(
+        content_type=ctype, content_id__isnull=False,
+        state__in=transition.states.values("id")).values("content_id")
+    queryset = queryset.filter(pk__in=sors)
+
+    if transition.condition.strip():
+        queryset = queryset.filter(workflows.conditions.compile_q(transition.condition, user, queryset.model))
+
+    return queryset
+
+
+@instrument("do_transition")
+def do_transition(obj, transition, user, version=None):
     """Processes the passed transition to the passed object (if allowed).
+
+    The state is changed with a single conditional UPDATE, which only
+    succeeds if the object is still in the state the transition has been
+    checked for. Of several concurrent transitions of the same object only
+    one is processed therefore. Returns True if the transition has been
+    processed, otherwise False.
+
+    **Parameters:**
+
+    obj
+        The object for which the transition should be processed. Can be any
+        Django model instance.
+
+    transition
+        The transition which should be processed. Can be a Transition instance
+        or a string with the transition name.
+
+    user
+        The user who processes the transition.
+
+    version
+        If given, the transition is only processed if the object's state has
+        still the passed version (see ``get_state_version``).
     """
     workflow = get_workflow(obj)
     if not isinstance(transition, Transition):
-        try:
-            transition = Transition.objects.get(name=transition, workflow=workflow)
-        except Transition.DoesNotExist:
+        if workflow is None:
+            return False
+        transition = get_graph(workflow).get_transition(transition)
+        if transition is None:
             return False
 
-    transitions = get_allowed_transitions(obj, user)
-    if transition in transitions:
-        set_state(obj, transition.destination)
-        return True
-    else:
+    state = get_state(obj)
+    if state is None or transition not in state.get_allowed_transitions(obj, user):
         return False
 
+    return _process_transition(obj, state, transition, user, version)
+
+
+@instrument("do_transition_path")
+def do_transition_path(obj, target_state, user, version=None):
+    """Moves the passed object to the target state along the shortest path
+    of transitions which are all allowed for the passed user. Returns True
+    if the object has been moved, otherwise False (e.g. if there is no such
+    path or the object is already in the target state).
 
+    The permission and the condition of every transition are checked for the
+    state the object is in at this step. Afterwards the state is changed with
+    a single conditional UPDATE (see ``do_transition``) and the permissions
+    are updated once. Every step is logged.
+
+    **Parameters:**
+
+    obj
+        The object which should be moved. Can be any Django model instance.
+
+    target_state
+        The state the object should be moved to. Can be a State instance or
+        a string with the state name.
+
+    user
+        The user who processes the transitions.
+
+    version
+        If given, the object is only moved if its state has still the passed
+        version (see ``get_state_version``).
+    """
+    state = get_state(obj)
+    if state is None:
+        return False
+
+    graph = get_graph(state.workflow_id)
+    if not isinstance(target_state, State):
+        target_state = dict((s.name, s) for s in graph.states.values()).get(target_state)
+        if target_state is None:
+            return False
+
+    path = graph.get_path(state, target_state, _PathChecker(obj, user, graph))
+    if not path:
+        return False
+
+    return _process_transitions(obj, state, path, user, version)
+
+
+def schedule_transition(obj, transition, due_at, user=None):
+    """Schedules the passed transition for the passed object. The transition
+    is processed by ``run_scheduled_transitions`` once it is due. Returns the
+    ScheduledTransition instance.
+
+    **Parameters:**
+
+    obj
+        The object for which the transition should be processed. Can be any
+        Django model instance.
+
+    transition
+        The transition which should be processed. Must be a Transition
+        instance.
+
+    due_at
+        The date and time from which on the transition should be processed.
+
+    user
+        The user on whose behalf the transition is processed. If None the
+        permission of the transition isn't checked (but its condition is).
+    """
+    return ScheduledTransition.objects.create(
+        content_type=ContentType.objects.get_for_model(obj), content_id=obj.id,
+        transition=transition, due_at=due_at, user=user)
+
+
+def run_scheduled_transitions(now=None, batch_size=None):
+    """Processes all due scheduled transitions and returns the amount of
+    processed ones.
+
+    The due transitions are claimed in batches, so that several runners can
+    work in parallel: each transition is leased by moving its due date by
+    ``WORKFLOWS_SCHEDULED_TRANSITION_LEASE`` seconds (default: 600) with a
+    conditional update, which fails if another runner has claimed it first.
+    No rows are locked. If a runner dies the transitions it has claimed are
+    due again after the lease, i.e. they are processed at least once; a
+    transition which has already been processed is not applicable anymore,
+    as the object has another state then.
+
+    A transition which has been processed or is not applicable anymore is
+    removed. If processing raises an exception the transition is rescheduled
+    with an exponential backoff.
+
+    **Parameters:**
+
+    now
+        The current date and time. Defaults to ``timezone.now()``.
+
+    batch_size
+        The amount of transitions which are claimed at once. Defaults to the
+        ``WORKFLOWS_CHUNK_SIZE`` setting or 500.
+    """
+    now = now or timezone.now()
+    batch_size = batch_size or _get_chunk_size()
+    leased_until = now + timedelta(seconds=getattr(settings, "WORKFLOWS_SCHEDULED_TRANSITION_LEASE", 600))
+
+    processed = 0
+    while True:
+        candidates = list(ScheduledTransition.objects.filter(due_at__lte=now).order_by("due_at", "id")[:batch_size])
+        if not candidates:
+            break
+
+        scheduled = []
+        for st in candidates:
+            if ScheduledTransition.objects.filter(pk=st.pk, due_at=st.due_at).update(due_at=leased_until):
+                scheduled.append(st)
+
+        objs = {}
+        for ctype, ids in _group_ids_by_content_type_id(scheduled).items():
+            for obj in ctype.model_class()._default_manager.filter(pk__in=ids):
+                objs[(ctype.id, obj.pk)] = obj
+
+        done = []
+        with batch():
+            for st in scheduled:
+                try:
+                    with batch():
+                        _process_scheduled_transition(objs.get((st.content_type_id, st.content_id)), st)
+                except Exception as e:
+                    ScheduledTransition.objects.filter(pk=st.pk).update(
+                        attempts=F("attempts") + 1, due_at=now + _get_retry_delay(st.attempts + 1),
+                        last_error="%s: %s" % (e.__class__.__name__, e))
+                else:
+                    done.append(st.id)
+
+            ScheduledTransition.objects.filter(pk__in=done).delete()
+        processed += len(scheduled)
+
+        if len(candidates) < batch_size:
+            break
+
+    return processed
+
+
+@instrument("update_permissions")
 def update_permissions(obj):
     """Updates the permissions of the passed object according to the object's
     current workflow state.
@@ -332,20 +712,798 @@ def update_permissions(obj):
     workflow = get_workflow(obj)
     state = get_state(obj)
 
-    # Remove all permissions for the workflow
-    ct = ContentType.objects.get_for_model(obj)
-    ps = [wpr.permission for wpr in WorkflowPermissionRelation.objects.filter(workflow=workflow)]
+    ctype = ContentType.objects.get_for_model(obj)
+    _update_permissions_for_ids(ctype, [obj.id], workflow, state)
+
+
+def migrate_workflow(old_workflow, new_workflow, state_map, ctype=None, chunk_size=None, progress=None):
+    """Replaces the old workflow by the new workflow: the content types and
+    objects which have the old workflow get the new one and the objects in a
+    state of the old workflow get the mapped state of the new workflow
+    (including its permissions).
 
-    ObjectPermission.objects.filter(content_type=ct, content_id=obj.id, permission__in=ps).delete()
+    The objects are processed in chunks, each within its own transaction. As
+    only objects which are still in a state of the old workflow are selected,
+    an interrupted migration can be resumed by calling the function again
+    with the same arguments.
 
-    # Grant permission for the state
-    for spr in StatePermissionRelation.objects.filter(state=state):
-        permissions.utils.grant_permission(obj, spr.role, spr.permission)
+    Returns the amount of migrated objects.
 
-    # Remove all inheritance blocks from the object
-    ObjectPermissionInheritanceBlock.objects.filter(
-        content_type=ct, content_id=obj.id, permission__in=ps).delete()
+    **Parameters:**
+
+    old_workflow
+        The workflow which is replaced. Can be a Workflow instance or a
+        string with the workflow name.
+
+    new_workflow
+        The workflow which replaces the old one. Can be a Workflow instance or
+        a string with the workflow name.
+
+    state_map
+        A dictionary which maps every state of the old workflow to a state of
+        the new workflow. The states can be given as State instances or names.
+
+    ctype
+        If given only this content type and its objects are migrated.
+
+    chunk_size
+        The amount of objects which are migrated at once. Defaults to the
+        ``WORKFLOWS_CHUNK_SIZE`` setting or 500.
+
+    progress
+        An optional callable which is called after every chunk with the amount
+        of migrated objects so far and the total amount of objects to migrate.
+    """
+    if not isinstance(old_workflow, Workflow):
+        old_workflow = Workflow.objects.get(name=old_workflow)
+    if not isinstance(new_workflow, Workflow):
+        new_workflow = Workflow.objects.get(name=new_workflow)
+    if old_workflow == new_workflow:
+        raise ValueError("The old and the new workflow must be different.")
+
+    state_map = _resolve_state_map(old_workflow, new_workflow, state_map)
+    chunk_size = chunk_size or _get_chunk_size()
+
+    # Relations are repointed first, so that objects which are created during
+    # the migration get the new workflow. This is idempotent on resume.
+    wmrs = WorkflowModelRelation.objects.filter(workflow=old_workflow)
+    wors = WorkflowObjectRelation.objects.filter(workflow=old_workflow)
+    sors = StateObjectRelation.objects.filter(state__in=list(state_map.keys()))
+    if ctype is not None:
+        wmrs = wmrs.filter(content_type=ctype)
+        wors = wors.filter(content_type=ctype)
+        sors = sors.filter(content_type=ctype)
+    wmrs.update(workflow=new_workflow)
+    wors.update(workflow=new_workflow)
+    workflows.cache.invalidate()
+
+    total = sors.count()
+    done = 0
+    while True:
+        with transaction.atomic():
+            rows = list(sors.select_for_update().order_by("pk").values_list(
+                "content_type", "content_id", "state")[:chunk_size])
+            if not rows:
+                break
+            _migrate_chunk(rows, old_workflow, new_workflow, state_map)
+        workflows.cache.invalidate()
+
+        done += len(rows)
+        if progress is not None:
+            progress(done, total)
+
+    return done
+
+
+def recompute_permissions(workflow=None, ctype=None, chunk_size=None, processes=1, progress=None, dry_run=False):
+    """Recomputes the permissions and inheritance blocks of all objects with
+    a state of the passed workflow and / or content type according to their
+    current states, e.g. after the permissions of states have been changed.
+    Returns the amount of (with ``dry_run`` affected) objects.
+
+    The content ids are partitioned into ranges of ``chunk_size`` objects,
+    which are processed by a pool of worker processes with own database
+    connections. Each range is processed within its own transaction. With
+    several processes the function must not be called within a transaction.
+
+    **Parameters:**
 
-    # Add inheritance blocks of this state to the object
-    for sib in StateInheritanceBlock.objects.filter(state=state):
-        permissions.utils.add_inheritance_block(obj, sib.permission)
+    workflow
+        If given only objects in a state of this workflow are processed. Can
+        be a Workflow instance or a string with the workflow name.
+
+    ctype
+        If given only objects of this content type are processed.
+
+    chunk_size
+        The amount of objects which are processed at once. Defaults to the
+        ``WORKFLOWS_CHUNK_SIZE`` setting or 500.
+
+    processes
+        The amount of worker processes. With 1 (and always with SQLite) the
+        objects are processed within the current process.
+
+    progress
+        An optional callable which is called after every chunk with the amount
+        of processed objects so far and the total amount of objects.
+
+    dry_run
+        If True only the amount of affected objects is returned.
+    """
+    if workflow is not None and not isinstance(workflow, Workflow):
+        workflow = Workflow.objects.get(name=workflow)
+    workflow_id = workflow.id if workflow is not None else None
+    chunk_size = chunk_size or _get_chunk_size()
+
+    sors = StateObjectRelation.objects.filter(content_id__isnull=False)
+    if workflow is not None:
+        sors = sors.filter(state__workflow=workflow)
+    if ctype is not None:
+        sors = sors.filter(content_type=ctype)
+
+    if dry_run:
+        return sors.count()
+
+    # The id space is partitioned per content type into ranges of chunk_size
+    # objects, so that only the boundaries are passed to the workers.
+    tasks = []
+    for ctype_id in sors.values_list("content_type", flat=True).distinct().order_by("content_type"):
+        ids = list(sors.filter(content_type=ctype_id).order_by("content_id").values_list("content_id", flat=True))
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            tasks.append((ctype_id, chunk[0], chunk[-1], workflow_id))
+
+    # SQLite allows only one writer at once.
+    if connection.vendor == "sqlite":
+        processes = 1
+
+    total = sors.count()
+    done = 0
+    if processes == 1:
+        results = (_recompute_permissions_for_range(task) for task in tasks)
+        pool = None
+    else:
+        # Workers must not share the connections of this process.
+        connections.close_all()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        results = pool.imap_unordered(_recompute_permissions_for_range, tasks)
+
+    try:
+        for count in results:
+            done += count
+            if progress is not None:
+                progress(done, total)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return done
+
+
+def get_state_counts(workflow, ctype=None):
+    """Returns the amount of objects per state of the passed workflow as
+    dictionary. The amounts are taken from the maintained counters, without
+    counting the objects.
+
+    **Parameters:**
+
+    workflow
+        The workflow for which the amounts should be returned. Must be a
+        Workflow instance.
+
+    ctype
+        If given, only objects of this content type are counted.
+    """
+    counts = StateObjectCount.objects.filter(workflow=workflow)
+    if ctype is not None:
+        counts = counts.filter(content_type=ctype)
+
+    states = State.objects.in_bulk(list(workflow.states.values_list("id", flat=True)))
+    result = dict((state, 0) for state in states.values())
+    for state_id, count in counts.values("state").annotate(total=Sum("count")).values_list("state", "total"):
+        result[states[state_id]] = count
+    return result
+
+
+def rebuild_state_counts(workflow=None):
+    """Recounts the objects per state and content type and replaces the
+    maintained counters (e.g. after states have been changed directly within
+    the database). Returns the amount of counters.
+
+    **Parameters:**
+
+    workflow
+        If given, only the counters of this workflow are rebuilt. Can be a
+        Workflow instance or a string with the workflow name.
+    """
+    counts = StateObjectCount.objects.all()
+    sors = StateObjectRelation.objects.filter(content_type__isnull=False)
+    if workflow is not None:
+        if not isinstance(workflow, Workflow):
+            workflow = Workflow.objects.get(name=workflow)
+        counts = counts.filter(workflow=workflow)
+        sors = sors.filter(state__workflow=workflow)
+
+    with transaction.atomic():
+        counts.delete()
+        rows = list(sors.values("state", "state__workflow", "content_type").annotate(
+            total=Count("id")).values_list("state", "state__workflow", "content_type", "total"))
+        StateObjectCount.objects.bulk_create([
+            StateObjectCount(state_id=state_id, workflow_id=workflow_id, content_type_id=ctype_id, count=total)
+            for state_id, workflow_id, ctype_id, total in rows])
+
+    return len(rows)
+
+
+@contextlib.contextmanager
+def batch():
+    """Context manager which processes the state changes within the block in
+    a single transaction. The transition log entries of all changes are
+    buffered and written with a single insert at the end of the block; if the
+    block raises an exception, the changes and the entries are discarded.
+    The changed states are written to the shared cache (see
+    ``workflows.cache``) after the outermost batch has been committed.
+
+    Batches can be nested; a nested batch is a savepoint whose entries are
+    written by the outermost batch (or discarded with the savepoint).
+
+    .. code-block:: python
+
+        with batch():
+            for obj in objs:
+                do_transition(obj, transition, user)
+    """
+    parent = getattr(_batch, "current", None)
+    current = _batch.current = _Batch()
+    try:
+        with transaction.atomic():
+            yield
+            if parent is None:
+                StateTransitionLog.objects.bulk_create(current.entries)
+    finally:
+        _batch.current = parent
+
+    if parent is not None:
+        parent.entries.extend(current.entries)
+        parent.callbacks.extend(current.callbacks)
+    else:
+        for func in current.callbacks:
+            _after_commit(func)
+
+
+# Private ####################################################################
+
+# Names of the attributes which hold the prefetched workflow and state of an
+# object (see prefetch_workflow_states).
+_WORKFLOW_ATTR = "_workflows_workflow"
+_STATE_ATTR = "_workflows_state"
+
+# The current batch per thread (see batch)
+_batch = threading.local()
+
+_PERMISSION_BASE_HAS_PERMISSION = getattr(
+    PermissionBase.has_permission, "__func__", PermissionBase.has_permission)
+
+
+def _update_prefetched(obj, **kwargs):
+    """Updates the prefetched workflow and / or state of the passed object (if
+    they have been prefetched).
+    """
+    for name, value in kwargs.items():
+        attr = "_workflows_%s" % name
+        if hasattr(obj, attr):
+            setattr(obj, attr, value)
+
+
+def _clear_prefetched(obj):
+    """Removes the prefetched workflow and state from the passed object.
+    """
+    for attr in (_WORKFLOW_ATTR, _STATE_ATTR):
+        try:
+            delattr(obj, attr)
+        except AttributeError:
+            pass
+
+
+def _get_granted_codenames(obj, user, codenames):
+    """Returns the codenames of the passed ones which are granted to passed
+    user for passed object.
+
+    This is the same as calling the object's ``has_permission`` method (in
+    case the object inherits from the PermissionBase class) or
+    ``permissions.utils.has_permission`` for every codename, but the user's
+    roles are loaded once and all codenames are checked with one query per
+    object (and ancestor).
+    """
+    if not codenames:
+        return set()
+
+    # An object specific has_permission method is used as it is.
+    has_permission = getattr(obj, "has_permission", None)
+    if has_permission is not None and \
+       getattr(has_permission, "__func__", None) is not _PERMISSION_BASE_HAS_PERMISSION:
+        return set(codename for codename in codenames if has_permission(user, codename))
+
+    if user.is_superuser:
+        return set(codenames)
+
+    if user.is_anonymous():
+        roles = []
+    else:
+        roles = [role.id for role in permissions.utils.get_roles(user, obj)]
+
+    granted = set()
+    pending = set(codenames)
+    while obj is not None and pending:
+        ctype = ContentType.objects.get_for_model(obj)
+        found = set(ObjectPermission.objects.filter(
+            content_type=ctype, content_id=obj.id, role__in=roles,
+            permission__codename__in=pending).values_list("permission__codename", flat=True))
+        granted.update(found)
+        pending.difference_update(found)
+
+        if pending:
+            pending.difference_update(ObjectPermissionInheritanceBlock.objects.filter(
+                content_type=ctype, content_id=obj.id,
+                permission__codename__in=pending).values_list("permission__codename", flat=True))
+
+        try:
+            obj = obj.get_parent_for_permissions()
+        except AttributeError:
+            obj = None
+
+    return granted
+
+
+def _log_state_changes(entries):
+    """Writes the passed StateTransitionLog entries. Within ``batch`` they
+    are buffered and written with one insert together with all other entries
+    of the batch, otherwise they are written at once.
+    """
+    current = getattr(_batch, "current", None)
+    if current is not None:
+        current.entries.extend(entries)
+    else:
+        StateTransitionLog.objects.bulk_create(entries)
+
+
+def _after_commit(func):
+    """Calls the passed function after the current transaction has been
+    committed: at the end of the outermost ``batch``, with
+    ``transaction.on_commit`` (Django >= 1.9) or at once if no transaction is
+    open. Otherwise the function is not called at all, hence it must only be
+    used for optional work like filling the cache.
+    """
+    current = getattr(_batch, "current", None)
+    if current is not None:
+        current.callbacks.append(func)
+    elif hasattr(transaction, "on_commit"):
+        transaction.on_commit(func)
+    elif not connection.in_atomic_block:
+        func()
+
+
+class _Batch(object):
+    """The buffered log entries and after commit callbacks of a ``batch``.
+    """
+    def __init__(self):
+        self.entries = []
+        self.callbacks = []
+
+
+def _get_chunk_size():
+    """Returns the amount of objects which are processed at once by the bulk
+    functions.
+    """
+    return getattr(settings, "WORKFLOWS_CHUNK_SIZE", 500)
+
+
+def _delete_in_chunks(queryset, chunk_size):
+    """Deletes the rows of the passed queryset with one DELETE per chunk, so
+    that large deletions don't lock the whole table for a long time.
+    """
+    while True:
+        pks = list(queryset.values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            break
+        queryset.model.objects.filter(pk__in=pks).delete()
+
+
+def _delete_states_in_chunks(queryset, chunk_size):
+    """Deletes the passed StateObjectRelations like ``_delete_in_chunks`` and
+    updates the object counts within the same transaction.
+    """
+    while True:
+        with transaction.atomic():
+            rows = list(queryset.values_list("pk", "content_type", "state")[:chunk_size])
+            if not rows:
+                break
+            StateObjectRelation.objects.filter(pk__in=[row[0] for row in rows]).delete()
+
+            changes = {}
+            for pk, ctype_id, state_id in rows:
+                changes.setdefault(ctype_id, []).append((state_id, -1))
+            for ctype_id, ctype_changes in changes.items():
+                _change_state_counts(ctype_id, ctype_changes)
+
+
+def _change_state_counts(ctype, changes):
+    """Applies the passed (state, delta) changes to the object counts of the
+    passed content type (or content type id), with one UPDATE per changed
+    state. The states can be State instances or ids; changes of the state
+    None are ignored. Must be called after the states have been changed.
+    """
+    deltas = {}
+    states = {}
+    for state, delta in changes:
+        if state is not None:
+            state_id = getattr(state, "id", state)
+            deltas[state_id] = deltas.get(state_id, 0) + delta
+            if isinstance(state, State):
+                states[state_id] = state
+
+    ctype_id = getattr(ctype, "id", ctype)
+    for state_id, delta in deltas.items():
+        if not delta:
+            continue
+        counts = StateObjectCount.objects.filter(state=state_id, content_type=ctype_id)
+        if counts.update(count=F("count") + delta):
+            continue
+
+        # A missing counter is seeded with the actual amount of objects, which
+        # already includes the changes of the current transaction.
+        if state_id in states:
+            workflow_id = states[state_id].workflow_id
+        else:
+            workflow_id = State.objects.filter(pk=state_id).values_list("workflow", flat=True)[0]
+        count = StateObjectRelation.objects.filter(state=state_id, content_type=ctype_id).count()
+        try:
+            with transaction.atomic():
+                StateObjectCount.objects.create(
+                    workflow_id=workflow_id, state_id=state_id, content_type_id=ctype_id, count=count)
+        except IntegrityError:
+            # Created concurrently, without the changes of this transaction
+            counts.update(count=F("count") + delta)
+
+
+def _process_transition(obj, state, transition, user, version=None):
+    """Moves the passed object from the passed state to the destination of
+    the passed transition (see ``do_transition``). The transition must have
+    been checked already.
+    """
+    return _process_transitions(obj, state, [transition], user, version)
+
+
+def _process_transitions(obj, state, path, user, version=None):
+    """Moves the passed object from the passed state along the passed path of
+    transitions to the destination of the last one, with a single state
+    change and permission update. The transitions must have been checked
+    already.
+    """
+    destination = path[-1].destination
+    ctype = ContentType.objects.get_for_model(obj)
+    sors = StateObjectRelation.objects.filter(content_type=ctype, content_id=obj.id, state=state)
+    if version is not None:
+        sors = sors.filter(version=version)
+
+    with transaction.atomic():
+        if not sors.update(state=destination, version=F("version") + 1):
+            # The memoized and cached states (if any) are outdated
+            _clear_prefetched(obj)
+            workflows.cache.delete_state(ctype, [obj.id])
+            return False
+        _change_state_counts(ctype, [(state, -1), (destination, 1)])
+        _update_prefetched(obj, state=destination)
+        update_permissions(obj)
+    workflows.cache.set_state(ctype, [obj.id], destination)
+
+    entries = []
+    from_state = state
+    for transition in path:
+        entries.append(StateTransitionLog(
+            content_type=ctype, content_id=obj.id, from_state=from_state, to_state=transition.destination,
+            transition=transition, user_id=getattr(user, "pk", None)))
+        from_state = transition.destination
+    _log_state_changes(entries)
+
+    return True
+
+
+class _PathChecker(object):
+    """Checks whether the user may take a transition from a state on the way
+    of an object to another state (see ``do_transition_path``).
+
+    The permissions which are managed by the workflow are checked as if the
+    object were in the state: via the roles the state grants them to, or -
+    unless the state blocks them - via the object's parent. Other permissions
+    don't depend on the state and are checked as they are.
+    """
+    def __init__(self, obj, user, graph):
+        self.obj = obj
+        self.user = user
+        self.graph = graph
+        self._roles = None
+
+    def __call__(self, state, transition):
+        if not workflows.conditions.evaluate(transition, self.obj, self.user, state):
+            return False
+        if transition.permission is None:
+            return True
+        return self.has_permission(state, transition.permission)
+
+    def has_permission(self, state, permission):
+        # An object specific has_permission method can't be checked for
+        # another state.
+        has_permission = getattr(self.obj, "has_permission", None)
+        if has_permission is not None and \
+           getattr(has_permission, "__func__", None) is not _PERMISSION_BASE_HAS_PERMISSION:
+            return has_permission(self.user, permission.codename)
+
+        if self.user.is_superuser:
+            return True
+
+        if permission not in self.graph.permissions:
+            return permission.codename in _get_granted_codenames(self.obj, self.user, [permission.codename])
+
+        for role, granted in self.graph.get_grants(state):
+            if granted == permission and role.id in self.get_roles():
+                return True
+
+        if permission in self.graph.get_blocks(state):
+            return False
+
+        try:
+            parent = self.obj.get_parent_for_permissions()
+        except AttributeError:
+            parent = None
+        if parent is None:
+            return False
+        return permission.codename in _get_granted_codenames(parent, self.user, [permission.codename])
+
+    def get_roles(self):
+        if self._roles is None:
+            if self.user.is_anonymous():
+                self._roles = set()
+            else:
+                self._roles = set(role.id for role in permissions.utils.get_roles(self.user, self.obj))
+        return self._roles
+
+
+def _process_scheduled_transition(obj, scheduled):
+    """Processes the passed scheduled transition for the passed object (None
+    if the object doesn't exist anymore). Returns False if the transition
+    isn't applicable.
+    """
+    if obj is None:
+        return False
+
+    state = get_state(obj)
+    if state is None:
+        return False
+
+    # The transition is taken from the cached graph of the workflow
+    for transition in get_graph(state.workflow_id).get_transitions(state):
+        if transition.id == scheduled.transition_id:
+            break
+    else:
+        return False
+
+    if scheduled.user_id is not None:
+        return do_transition(obj, transition, scheduled.user)
+
+    if not workflows.conditions.evaluate(transition, obj, None, state):
+        return False
+
+    return _process_transition(obj, state, transition, None)
+
+
+def _get_retry_delay(attempts):
+    """Returns the delay after the passed amount of failed attempts to process
+    a scheduled transition: one minute, doubled per attempt, one day at most.
+    """
+    return timedelta(minutes=min(2 ** (attempts - 1), 24 * 60))
+
+
+def _group_ids_by_content_type_id(rows):
+    """Returns the content ids of the passed rows (with content_type_id and
+    content_id attributes) grouped by content type.
+    """
+    result = {}
+    for row in rows:
+        result.setdefault(row.content_type_id, []).append(row.content_id)
+    return dict((ContentType.objects.get_for_id(ctype_id), ids) for ctype_id, ids in result.items())
+
+
+def _init_worker():
+    """Initializes a worker process of ``recompute_permissions``.
+    """
+    django.setup()
+    connections.close_all()
+
+
+def _recompute_permissions_for_range(task):
+    """Recomputes the permissions of the objects of passed content type within
+    passed id range and returns their amount.
+
+    task
+        A tuple of content type id, first id, last id and workflow id (or
+        None).
+    """
+    ctype_id, first_id, last_id, workflow_id = task
+    ctype = ContentType.objects.get_for_id(ctype_id)
+
+    sors = StateObjectRelation.objects.filter(content_type=ctype, content_id__range=(first_id, last_id))
+    if workflow_id is not None:
+        sors = sors.filter(state__workflow=workflow_id)
+
+    ids_by_state = {}
+    for content_id, state_id in sors.values_list("content_id", "state"):
+        ids_by_state.setdefault(state_id, []).append(content_id)
+
+    with transaction.atomic():
+        for state in State.objects.filter(pk__in=list(ids_by_state.keys())):
+            _update_permissions_for_ids(ctype, ids_by_state[state.id], state.workflow_id, state)
+
+    return sum(len(ids) for ids in ids_by_state.values())
+
+
+def _resolve_state_map(old_workflow, new_workflow, state_map):
+    """Returns the passed state map as dictionary of old state ids to new
+    State instances. Raises ValueError if the map doesn't cover all states of
+    the old workflow or contains states of other workflows.
+    """
+    old_states = dict((state.name, state) for state in old_workflow.states.all())
+    new_states = dict((state.name, state) for state in new_workflow.states.all())
+
+    result = {}
+    for old_state, new_state in state_map.items():
+        old_state = old_states.get(getattr(old_state, "name", old_state))
+        new_state = new_states.get(getattr(new_state, "name", new_state))
+        if old_state is None or new_state is None:
+            raise ValueError("The state map contains states which don't belong to the workflows.")
+        result[old_state.id] = new_state
+
+    missing = [name for name, state in old_states.items() if state.id not in result]
+    if missing:
+        raise ValueError("The state map doesn't cover the states: %s." % ", ".join(sorted(missing)))
+
+    return result
+
+
+def _migrate_chunk(rows, old_workflow, new_workflow, state_map):
+    """Moves the objects of the passed (content type id, content id, state id)
+    rows into the mapped states and replaces their permissions.
+    """
+    groups = {}
+    for ctype_id, content_id, state_id in rows:
+        groups.setdefault((ctype_id, state_id), []).append(content_id)
+
+    now = timezone.now()
+    entries = []
+    for (ctype_id, state_id), ids in groups.items():
+        ctype = ContentType.objects.get_for_id(ctype_id)
+        new_state = state_map[state_id]
+
+        StateObjectRelation.objects.filter(content_type=ctype, content_id__in=ids, state=state_id).update(
+            state=new_state, version=F("version") + 1)
+        _change_state_counts(ctype, [(state_id, -len(ids)), (new_state, len(ids))])
+
+        # Remove the permissions managed by the old workflow, then apply the
+        # ones of the new state.
+        _update_permissions_for_ids(ctype, ids, old_workflow, None)
+        _update_permissions_for_ids(ctype, ids, new_workflow, new_state)
+
+        entries.extend(
+            StateTransitionLog(content_type=ctype, content_id=id, from_state_id=state_id,
+                               to_state=new_state, timestamp=now)
+            for id in ids)
+
+    _log_state_changes(entries)
+
+
+def _group_ids_by_content_type(objs):
+    """Returns the ids of the passed objects grouped by their content types.
+
+    objs
+        A queryset or any iterable of Django model instances.
+    """
+    if hasattr(objs, "values_list"):
+        ctype = ContentType.objects.get_for_model(objs.model)
+        ids = list(objs.values_list("pk", flat=True))
+        return {ctype: ids} if ids else {}
+
+    result = {}
+    for obj in objs:
+        ctype = ContentType.objects.get_for_model(obj)
+        result.setdefault(ctype, []).append(obj.pk)
+    return result
+
+
+def _set_state_for_ids(ctype, ids, state):
+    """Sets the passed state to the objects with passed content type and ids
+    and updates their permissions.
+    """
+    with transaction.atomic():
+        existing = dict(StateObjectRelation.objects.filter(
+            content_type=ctype, content_id__in=ids).values_list("content_id", "state"))
+
+        if existing:
+            StateObjectRelation.objects.filter(
+                content_type=ctype, content_id__in=list(existing.keys())).update(
+                state=state, version=F("version") + 1)
+
+        StateObjectRelation.objects.bulk_create([
+            StateObjectRelation(content_type=ctype, content_id=id, state=state)
+            for id in ids if id not in existing])
+        _change_state_counts(ctype, [(state_id, -1) for state_id in existing.values()] + [(state, len(ids))])
+
+        _update_permissions_for_ids(ctype, ids, state.workflow_id, state)
+
+        now = timezone.now()
+        _log_state_changes([
+            StateTransitionLog(content_type=ctype, content_id=id, from_state_id=existing.get(id),
+                               to_state=state, timestamp=now)
+            for id in ids])
+    workflows.cache.set_state(ctype, ids, state)
+
+
+def _update_permissions_for_ids(ctype, ids, workflow, state):
+    """Updates the permissions of the objects with passed content type and
+    ids according to the passed workflow state.
+
+    Only the difference between the current permissions / inheritance blocks
+    and the ones of the state is written: one delete and one insert at most
+    for each of them.
+    """
+    if workflow is None:
+        return
+
+    graph = get_graph(workflow)
+    ps = set(permission.id for permission in graph.permissions)
+    if state is None:
+        grants = blocks = set()
+    else:
+        grants = set((role.id, permission.id) for role, permission in graph.get_grants(state))
+        blocks = set(permission.id for permission in graph.get_blocks(state))
+
+    # Permissions. The ones which are managed by the workflow but not granted
+    # by the state are removed. The ones which are granted by the state are
+    # added if they don't exist yet.
+    delete = []
+    existing = set()
+    for id, content_id, role_id, permission_id in ObjectPermission.objects.filter(
+            content_type=ctype, content_id__in=ids,
+            permission__in=ps | set(p for (r, p) in grants)).values_list(
+            "id", "content_id", "role", "permission"):
+        key = (content_id, role_id, permission_id)
+        if permission_id in ps and ((role_id, permission_id) not in grants or key in existing):
+            delete.append(id)
+        existing.add(key)
+
+    if delete:
+        ObjectPermission.objects.filter(pk__in=delete).delete()
+
+    ObjectPermission.objects.bulk_create([
+        ObjectPermission(content_type=ctype, content_id=id, role_id=role_id, permission_id=permission_id)
+        for id in ids for (role_id, permission_id) in grants
+        if (id, role_id, permission_id) not in existing])
+
+    # Inheritance blocks, likewise.
+    delete = []
+    existing = set()
+    for id, content_id, permission_id in ObjectPermissionInheritanceBlock.objects.filter(
+            content_type=ctype, content_id__in=ids, permission__in=ps | blocks).values_list(
+            "id", "content_id", "permission"):
+        key = (content_id, permission_id)
+        if permission_id in ps and (permission_id not in blocks or key in existing):
+            delete.append(id)
+        existing.add(key)
+
+    if delete:
+        ObjectPermissionInheritanceBlock.objects.filter(pk__in=delete).delete()
+
+    ObjectPermissionInheritanceBlock.objects.bulk_create([
+        ObjectPermissionInheritanceBlock(content_type=ctype, content_id=id, permission_id=permission_id)
+        for id in ids for permission_id in blocks
+        if (id, permission_id) not in existing])